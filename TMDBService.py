@@ -1,22 +1,51 @@
 import pandas as pd
+import requests
 from tmdbv3api import TMDb, Movie
 import os
 from typing import Optional
 
-from config import CSV_FILES
+from config import CSV_FILES, UPSTREAM_TIMEOUTS
+from resilience import UPSTREAMS
+from snapshot import get_snapshot
+
+class TimeoutSession(requests.Session):
+    """requests session with a default timeout, which tmdbv3api never sets."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
 
 class TMDBService:
+    # Calls to TMDB go through its circuit breaker and timeout. Failures,
+    # including an open breaker, are caught below and return None, leaving the
+    # local database details in place.
     def __init__(self):
-        self.tmdb = TMDb()
+        # tmdbv3api's response cache calls requests.request without a session,
+        # and so without a timeout; it is disabled so every call times out.
+        self.tmdb = TMDb(session=TimeoutSession(UPSTREAM_TIMEOUTS['tmdb']))
+        self.tmdb.cache = False
         self.tmdb.api_key = os.getenv('TMDB_API_KEY')
         print('TMDB KEY: ', self.tmdb.api_key)
         self.movie = Movie()
         self.base_image_url = "https://image.tmdb.org/t/p/w200"
-        self.links_df = pd.read_csv(CSV_FILES['links'])
+        # Links are read from the shared catalog snapshot, looked up on every
+        # call so a rewritten snapshot is picked up; the CSV is only loaded if
+        # no snapshot has been written yet.
+        self.links_df = pd.read_csv(CSV_FILES['links']) if get_snapshot() is None else None
 
     def get_tmdb_id(self, imdb_id: str) -> Optional[int]:
         try:
             imdb_id = int(imdb_id.replace('tt', ''))
+            snapshot = get_snapshot()
+            if snapshot is not None:
+                row = snapshot.row_of_imdb_id(imdb_id)
+                return snapshot.tmdb_id(row) if row is not None else None
+            if self.links_df is None:
+                self.links_df = pd.read_csv(CSV_FILES['links'])
             row = self.links_df[self.links_df['imdbId'] == imdb_id]
             if not row.empty:
                 return int(row['tmdbId'].iloc[0])
@@ -27,7 +56,7 @@ class TMDBService:
 
     def get_movie_poster_rating_overview(self, tmdb_id: int) -> Optional[dict]:
         try:
-            movie = self.movie.details(tmdb_id)
+            movie = UPSTREAMS['tmdb'].call(self.movie.details, tmdb_id)
             if movie:
                 return {
                     "poster_url": f"{self.base_image_url}{movie.poster_path}" if movie.poster_path else None,
@@ -74,8 +103,8 @@ class TMDBService:
     def get_overview_actors_director(self, tmdb_id):
         actors, director, overview = None, None, None
         try:
-            movie = self.movie.details(tmdb_id)
-            credits = self.movie.credits(tmdb_id)
+            movie = UPSTREAMS['tmdb'].call(self.movie.details, tmdb_id)
+            credits = UPSTREAMS['tmdb'].call(self.movie.credits, tmdb_id)
             
             if movie:
                 overview = movie.overview if movie.overview else None
@@ -100,7 +129,7 @@ class TMDBService:
     
     def get_movie_keywords(self,tmdb_id: int) -> Optional[list]:
         try:
-            keywords = self.movie.keywords(tmdb_id)
+            keywords = UPSTREAMS['tmdb'].call(self.movie.keywords, tmdb_id)
             if keywords:
                 return [keyword['name'] for keyword in keywords['keywords']]
             return None
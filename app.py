@@ -1,19 +1,86 @@
-from flask import Flask, render_template, request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
+import json
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
+from batch import recommend_batch
+from config import BATCH_CONCURRENCY, BATCH_MAX_QUERIES
 from TMDBService import TMDBService
-from database import attach_imdb_links
-from main import find_recommendations
+from database import attach_imdb_links, attach_posters, attach_ratings_overviews
+from main import coalescing_stats, find_recommendations
+from profiling import profile_request, profiling_requested
+from resilience import request_budget, upstream_states
 
 app = Flask(__name__)
 
+# Number of TMDB detail fetches run in parallel for a streamed response
+TMDB_WORKERS = 5
+
+# Fields of a recommendation sent to the browser
+STREAMED_FIELDS = ['id', 'title', 'year', 'genres', 'actors', 'director', 'imdb_url', 'poster_url', 'rating', 'plot']
+
 
 def add_movie_details(recommendations):
     tm = TMDBService()
     for movie in recommendations:
-        tmdb_id = tm.get_tmdb_id(movie['imdb_id'])
-        if tmdb_id:
-            details = tm.get_movie_poster_rating_overview(tmdb_id)
-            if details:
-                movie.update(details)
+        add_details_for_movie(tm, movie)
+
+def add_details_for_movie(tm, movie):
+    tmdb_id = tm.get_tmdb_id(movie['imdb_id']) if movie.get('imdb_id') else None
+    if tmdb_id:
+        details = tm.get_movie_poster_rating_overview(tmdb_id)
+        if details:
+            movie.update({key: value for key, value in details.items() if value is not None})
+    return movie
+
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_recommendations(user_input):
+    """Yield server-sent events for a recommendation request as results become available.
+
+    Events:
+        results: The ranked movies, as soon as the search returns, with the
+            poster, rating and plot from the local database as a fallback.
+        details: One per movie, once its TMDB poster, rating and plot arrive.
+        error: The request failed; data holds the message.
+        done: No more events follow.
+    """
+    try:
+        recommendations = find_recommendations(user_input)
+    except Exception as e:
+        yield server_sent_event('error', {'message': str(e)})
+        yield server_sent_event('done', {})
+        return
+
+    attach_imdb_links(recommendations)
+    attach_posters(recommendations)
+    attach_ratings_overviews(recommendations)
+    yield server_sent_event('results', [
+        dict({field: movie.get(field) for field in STREAMED_FIELDS}, rank=rank)
+        for rank, movie in enumerate(recommendations, 1)
+    ])
+
+    tm = TMDBService()
+    executor = ThreadPoolExecutor(max_workers=TMDB_WORKERS)
+    try:
+        # Each fetch runs in a copy of this context, so they share one budget
+        with request_budget():
+            futures = {executor.submit(contextvars.copy_context().run, add_details_for_movie, tm, movie): rank
+                       for rank, movie in enumerate(recommendations, 1)}
+        for future in as_completed(futures):
+            try:
+                movie = future.result()
+            except Exception as e:
+                print(f"Error fetching movie details: {e}")
+                continue
+            yield server_sent_event('details', dict(
+                {field: movie.get(field) for field in ['id', 'poster_url', 'rating', 'plot']},
+                rank=futures[future]
+            ))
+    finally:
+        # Stop pending fetches if the client disconnected
+        executor.shutdown(wait=False, cancel_futures=True)
+    yield server_sent_event('done', {})
 
 @app.route('/', methods=['GET', 'POST'])
 def home():
@@ -21,11 +88,52 @@ def home():
     user_input = ""
     if request.method == 'POST':
         user_input = request.form['user_input']
-        recommendations = find_recommendations(user_input)
-        attach_imdb_links(recommendations)
-        add_movie_details(recommendations)
+        with profile_request('home', profiling_requested(request.headers, request.path)), request_budget():
+            recommendations = find_recommendations(user_input)
+            attach_imdb_links(recommendations)
+            # Local details first, so they remain if TMDB is unavailable
+            attach_posters(recommendations)
+            attach_ratings_overviews(recommendations)
+            add_movie_details(recommendations)
 
     return render_template('recommendations.html', recommendations=recommendations, user_input=user_input)
 
+@app.route('/stream', methods=['GET', 'POST'])
+def stream():
+    """Progressive version of home: recommendations as a server-sent event stream."""
+    user_input = request.values.get('user_input', '')
+    return Response(
+        stream_with_context(stream_recommendations(user_input)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/recommend/batch', methods=['POST'])
+def recommend_batch_api():
+    """Recommendations for a list of queries.
+
+    Request body: {"queries": ["a movie about being lonely", ...], "concurrency": 8}
+    Response: {"results": [{"query", "recommendations", "error", "source", "degraded"}, ...], "summary": {...}}
+    """
+    body = request.get_json(silent=True) or {}
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return jsonify(error='"queries" must be a list of strings'), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify(error=f'At most {BATCH_MAX_QUERIES} queries per request'), 400
+    concurrency = body.get('concurrency', BATCH_CONCURRENCY)
+    if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+        return jsonify(error='"concurrency" must be a positive integer'), 400
+    concurrency = min(concurrency, BATCH_CONCURRENCY)
+
+    with profile_request('batch', profiling_requested(request.headers, request.path)):
+        results, summary = recommend_batch(queries, concurrency)
+    return jsonify(results=results, summary=summary)
+
+@app.route('/health/upstreams')
+def upstream_health():
+    """Circuit breaker state of each upstream and request coalescing counts."""
+    return jsonify(upstreams=upstream_states(), coalescing=coalescing_stats())
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
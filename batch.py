@@ -0,0 +1,150 @@
+# Batch recommendations for many queries at once, e.g. nightly precomputation
+# of curated prompts. Tag extraction runs with bounded concurrency, searches are
+# grouped into Marqo bulk requests where the server supports them, and the
+# database details of every recommendation are fetched in one query.
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import time
+from typing import Any, Dict, List, Tuple
+
+from config import (
+    BATCH_CONCURRENCY, BULK_SEARCH_SECONDS_PER_QUERY, BULK_SEARCH_SIZE, UPSTREAM_CONCURRENCY, UPSTREAM_TIMEOUTS,
+)
+from database import attach_movie_details, local_search
+from main import build_search, extract_preferences, extraction_flight, rank_results
+from profiling import bind_to_request
+from resilience import UPSTREAMS, UpstreamError
+from singleflight import normalize_input
+from vectordb import bulk_search_movies, cached_search, search_movies
+
+logger = logging.getLogger(__name__)
+
+# Where results came from when nothing had to fall back
+PRIMARY_SOURCES = {'extraction': 'llm', 'search': 'marqo_bulk'}
+
+
+def search_one(search):
+    """Return (results, source) for one search, for when bulk requests fail.
+
+    Runs on the marqo_bulk upstream rather than the interactive marqo one, so a
+    batch cannot take the workers or trip the breaker of interactive searches.
+    Falls back to cached results ('cache') or a local search ('local').
+    """
+    keywords, filter = search
+    try:
+        return UPSTREAMS['marqo_bulk'].call(search_movies, keywords, filter), 'marqo_bulk'
+    except UpstreamError as e:
+        logger.warning(f"Search unavailable, using local results: {e}")
+    cached = cached_search(keywords, filter)
+    if cached is not None:
+        return cached, 'cache'
+    return local_search(keywords, filter), 'local'
+
+
+def search_all(searches, concurrency=BATCH_CONCURRENCY):
+    """Return ({(keywords, filter): (results, source)}, bulk calls) for every distinct search.
+
+    Uses Marqo bulk requests of BULK_SEARCH_SIZE searches. Bulk requests are a
+    separate upstream with a deadline that grows with their size, so a slow
+    or missing bulk endpoint does not open the breaker of single searches. If
+    a bulk request fails, the remaining searches run one by one with
+    search_one, at most as many at a time as the marqo_bulk upstream has
+    workers.
+    """
+    searches = list(dict.fromkeys(searches))
+    results = {}
+    bulk_calls = 0
+    position = 0
+    while position < len(searches):
+        chunk = searches[position:position + BULK_SEARCH_SIZE]
+        try:
+            timeout = UPSTREAM_TIMEOUTS['marqo_bulk'] + BULK_SEARCH_SECONDS_PER_QUERY * len(chunk)
+            chunk_results = UPSTREAMS['marqo_bulk'].call(bulk_search_movies, chunk, timeout=timeout)
+        except UpstreamError as e:
+            logger.warning(f"Bulk search unavailable, searching one by one: {e}")
+            break
+        results.update((search, (search_results, 'marqo_bulk')) for search, search_results in zip(chunk, chunk_results))
+        bulk_calls += 1
+        position += len(chunk)
+
+    remaining = searches[position:]
+    if remaining:
+        with ThreadPoolExecutor(max_workers=min(concurrency, UPSTREAM_CONCURRENCY['marqo_bulk'])) as executor:
+            results.update(zip(remaining, executor.map(bind_to_request(search_one), remaining)))
+    return results, bulk_calls
+
+def recommend_batch(queries: List[str], concurrency: int = BATCH_CONCURRENCY) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Recommend movies for every query.
+
+    Args:
+        queries (List[str]): User sentences, as typed into the web form
+        concurrency (int): Maximum number of tag extractions in flight
+
+    Returns:
+        Tuple of
+            - one {"query", "recommendations", "error", "source", "degraded"} dict
+              per query, in order. source is {"extraction": "llm" | "local" |
+              "sentence", "search": "marqo_bulk" | "cache" | "local"}; degraded
+              is true if either of them is a fallback.
+            - a summary with counts, elapsed seconds and queries/sec
+    """
+    start = time.perf_counter()
+    keys = [normalize_input(query) for query in queries]
+    # Identical queries are extracted once
+    unique = {key: query for key, query in zip(keys, queries)}
+
+    def extract(item):
+        key, query = item
+        try:
+            preferences = extraction_flight.do(key, extract_preferences, query)
+            return key, build_search(preferences), preferences.source, None
+        except Exception as e:
+            logger.error(f"Error extracting tags for {query!r}: {e}")
+            return key, None, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        extracted = {key: (search, source, error)
+                     for key, search, source, error in executor.map(bind_to_request(extract), unique.items())}
+
+    search_results, bulk_calls = search_all(
+        [search for search, _, _ in extracted.values() if search is not None], concurrency)
+
+    results = []
+    for query, key in zip(queries, keys):
+        search, extraction_source, error = extracted[key]
+        found, search_source = search_results[search] if search is not None else ({}, None)
+        source = {"extraction": extraction_source, "search": search_source}
+        results.append({
+            "query": query,
+            "recommendations": rank_results(found) if search is not None else [],
+            "error": error,
+            "source": source,
+            "degraded": error is None and source != PRIMARY_SOURCES,
+        })
+
+    attach_movie_details([movie for result in results for movie in result["recommendations"]])
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "queries": len(queries),
+        "unique_queries": len(unique),
+        "searches": len(search_results),
+        "bulk_search_calls": bulk_calls,
+        "errors": sum(1 for result in results if result["error"]),
+        "degraded": sum(1 for result in results if result["degraded"]),
+        "seconds": elapsed,
+        "queries_per_sec": len(queries) / elapsed if elapsed else None,
+    }
+    return results, summary
+
+def run_batch_file(input_path, output_path, concurrency=BATCH_CONCURRENCY):
+    """Read one query per line from input_path and write JSONL results to output_path."""
+    with open(input_path, encoding='utf-8') as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    results, summary = recommend_batch(queries, concurrency)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    return summary
@@ -0,0 +1,359 @@
+# Data-scale benchmarks.
+# Generates synthetic catalogs (see synthetic_data.py) at increasing scales and
+# times every ingest and document-building stage against a fresh SQLite
+# database. Each stage runs in its own process so its peak RSS is measured on
+# its own, and stages whose time grows faster than the catalog are flagged.
+#
+# The llm benchmark compares the tokens sent to and received from the LLM by
+# tag extraction before and after the structured-output change, against a
+# local fake of the OpenAI chat completions endpoint.
+#
+# Usage:
+#   python benchmarks.py ingest --scales 10000 100000 1000000
+#   python benchmarks.py ingest --scales 10000 100000 --with-index   # needs Marqo
+#   python benchmarks.py llm
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+from config import GENRES, USER_REQUESTS
+from synthetic_data import generate_catalog
+
+# A stage is flagged when, between two scales, its time grows like
+# rows ** SUPERLINEAR_EXPONENT or worse.
+SUPERLINEAR_EXPONENT = 1.15
+
+INGEST_STAGES = [
+    'load_movies',
+    'load_keywords',
+    'load_actors',
+    'load_links',
+    'build_movie_documents',
+    'format_movies',
+    'iter_movie_documents',
+    'write_snapshot',
+]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _count(session, model):
+    from sqlalchemy import func, select
+    return session.scalar(select(func.count()).select_from(model))
+
+def _run_stage(stage, db_location, data_dir, queue):
+    """Run one stage in a child process and report (seconds, rows, peak RSS)."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import database
+    from models import Actor, Base, Keyword, Link, Movie
+    import snapshot
+
+    engine = create_engine(db_location)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    csv_path = lambda name: os.path.join(data_dir, f'{name}.csv')
+    rss_before = peak_rss_mb()
+
+    with Session() as session:
+        start = time.perf_counter()
+        if stage == 'load_movies':
+            database.load_movies_from_csv(session, csv_path('movies'))
+            elapsed = time.perf_counter() - start
+            rows = _count(session, Movie)
+        elif stage == 'load_keywords':
+            database.load_keywords_from_csv(session, csv_path('keywords'))
+            elapsed = time.perf_counter() - start
+            rows = _count(session, Keyword)
+        elif stage == 'load_actors':
+            database.load_actors_from_csv(session, csv_path('actors'))
+            elapsed = time.perf_counter() - start
+            rows = _count(session, Actor)
+        elif stage == 'load_links':
+            database.load_links_from_csv(session, csv_path('links'))
+            elapsed = time.perf_counter() - start
+            rows = _count(session, Link)
+        elif stage == 'build_movie_documents':
+            rows = database.build_movie_documents(session)
+            elapsed = time.perf_counter() - start
+        elif stage == 'format_movies':
+            # The join-based document path used before movie_documents existed
+            rows = len(database.format_movies(database.get_relevant_movie_fields(session)))
+            elapsed = time.perf_counter() - start
+        elif stage == 'iter_movie_documents':
+            rows = sum(1 for _ in database.iter_movie_documents(session))
+            elapsed = time.perf_counter() - start
+        elif stage == 'write_snapshot':
+            rows = snapshot.write_snapshot(session, os.path.join(os.path.dirname(data_dir), 'movies.snapshot'))
+            elapsed = time.perf_counter() - start
+        elif stage == 'add_movies_to_index':
+            import vectordb
+            documents = list(database.iter_movie_documents(session))
+            start = time.perf_counter()
+            vectordb.add_movies_to_index(documents)
+            elapsed = time.perf_counter() - start
+            rows = len(documents)
+        else:
+            raise ValueError(f"Unknown stage: {stage}")
+
+    queue.put({'seconds': elapsed, 'rows': rows, 'rss_before_mb': rss_before, 'peak_rss_mb': peak_rss_mb()})
+
+def run_stage(stage, db_location, data_dir):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, db_location, data_dir, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {process.exitcode}")
+    return queue.get()
+
+def benchmark_ingest(scales, workdir, stages, seed=42):
+    """Run every stage at every scale and return one result dict per (scale, stage)."""
+    results = []
+    for scale in scales:
+        scale_dir = os.path.join(workdir, str(scale))
+        data_dir = os.path.join(scale_dir, 'csv')
+        db_path = os.path.join(scale_dir, 'movies.db')
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+        start = time.perf_counter()
+        generate_catalog(data_dir, scale, seed)
+        print(f"\n[{scale} movies] generated in {time.perf_counter() - start:.1f}s")
+
+        for stage in stages:
+            result = run_stage(stage, f'sqlite:///{db_path}', data_dir)
+            result.update({
+                'scale': scale,
+                'stage': stage,
+                'rows_per_sec': result['rows'] / result['seconds'] if result['seconds'] else None,
+            })
+            results.append(result)
+            print(f"  {stage:<22} {result['seconds']:>9.2f}s {result['rows']:>11} rows "
+                  f"{result['rows_per_sec'] or 0:>12.0f} rows/s {result['peak_rss_mb']:>9.1f} MB peak")
+    return results
+
+def find_superlinear(results):
+    """Return (stage, scale_from, scale_to, exponent) for stages that scale worse than linearly."""
+    flagged = []
+    by_stage = {}
+    for result in results:
+        by_stage.setdefault(result['stage'], []).append(result)
+    for stage, runs in by_stage.items():
+        runs.sort(key=lambda run: run['scale'])
+        for previous, current in zip(runs, runs[1:]):
+            if previous['seconds'] <= 0 or current['scale'] == previous['scale']:
+                continue
+            exponent = math.log(current['seconds'] / previous['seconds']) / math.log(current['scale'] / previous['scale'])
+            if exponent > SUPERLINEAR_EXPONENT:
+                flagged.append((stage, previous['scale'], current['scale'], exponent))
+    return flagged
+
+# Tag extraction prompt used before structured outputs, kept for comparison
+LEGACY_EXTRACTION_PROMPT = f'''Act as a specialized assistant who extracts tags from user input. The user will input a sentence describing the kind of movie they would like to watch. Extract the following tags from the input:
+1. Movie Title: Also decide if the user wants to watch something similar to this movie or not.
+2. Actors: Extract a list of actors if mentioned. For each actor specify whether the user would like that actor to be in the movie or not.
+3. Genres: Extract a list of genres if mentioned. Each genre should be one of the following values: 
+      ```{GENRES}```
+For each genre specify whether the user would like to watch a movie of that genre or not. 
+4. Era: If mentioned, include the era of the desired movie. Output one of two values, 'recent' or 'old'.
+5. Keywords: Any other relevant keywords mentioned by the user.
+
+Output the extracted tags in the JSON format as shown in the examples below. 
+Examples:
+1. User input: "I want to watch a action movie, but not a comedy, starring Tom Cruise. The movie should have good dialogues and a twist in the ending. I do not want to watch a Penelope Cruz movie."
+   Output: {{
+                     "title": null
+                     "genres": [["action", 1], ["comedy", 0]]
+                     "actors": [["Tom Cruise", 1], ["Penelope Cruz", 0]] 
+                     "era": null
+                     "keywords": ["good dialogues", "twist in the ending"]
+                     }}
+
+2. User input: "I want to watch an old dramatic musical. The movie should have great music and should be inspiring. "
+   Output: {{
+                     "title": null
+                     "genres": [["musical", 1], ["drama", 1]]
+                     "actors": null 
+                     "era": "old"
+                     "keywords": ["great music", "inspiring"]
+                     }}
+
+Do not infer any information. Include a title only if it is a valid movie name.
+'''
+
+# What the fake endpoint answers. Both encode the same preferences, in the
+# shape each prompt asks for, and are serialised compactly so only the shape
+# differs.
+LEGACY_COMPLETION = json.dumps({
+    "title": None,
+    "genres": [["thriller", 1], ["comedy", 0]],
+    "actors": [["Christopher Nolan", 1]],
+    "era": None,
+    "keywords": ["twist in the ending"],
+}, separators=(',', ':'))
+STRUCTURED_COMPLETION = {
+    "title": None,
+    "genres": ["Thriller"],
+    "excluded_genres": ["Comedy"],
+    "actors": ["Christopher Nolan"],
+    "excluded_actors": [],
+    "era": None,
+    "keywords": ["twist in the ending"],
+}
+
+def token_counter():
+    """Return (count_tokens, description), using tiktoken when it is available."""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding('o200k_base')
+        return (lambda text: len(encoding.encode(text))), 'tiktoken o200k_base'
+    except Exception:
+        # Rough stand-in for a BPE tokenizer: GPT-style pre-tokens (words,
+        # digit groups, punctuation runs, whitespace runs), one token each
+        pattern = re.compile(r" ?[A-Za-z]+| ?[0-9]{1,3}| ?[^\sA-Za-z0-9]+|\s+(?!\S)|\s+")
+        return (lambda text: len(pattern.findall(text))), 'approximate (tiktoken unavailable)'
+
+class FakeChatCompletions(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /chat/completions endpoint that records requests."""
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        FakeChatCompletions.requests.append(body)
+        if body.get('response_format'):
+            content = json.dumps(STRUCTURED_COMPLETION, separators=(',', ':'))
+        else:
+            content = LEGACY_COMPLETION
+        response = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body['model'],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+def benchmark_llm(sentences):
+    """Send every sentence through the legacy and the structured extraction.
+
+    Returns one summary dict per variant with mean input/output tokens and
+    mean round-trip time to the fake endpoint.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeChatCompletions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    os.environ.setdefault('OPENAI_API_KEY', 'fake')
+
+    from openai import OpenAI
+    import main as recommender
+    count_tokens, tokenizer = token_counter()
+
+    def run(variant, extract):
+        FakeChatCompletions.requests.clear()
+        failures = 0
+        start = time.perf_counter()
+        for sentence in sentences:
+            try:
+                extract(sentence)
+            except ValueError:
+                failures += 1
+        elapsed = time.perf_counter() - start
+        input_tokens = output_tokens = 0
+        for body in FakeChatCompletions.requests:
+            input_tokens += sum(count_tokens(message['content']) for message in body['messages'])
+            if body.get('response_format'):
+                input_tokens += count_tokens(json.dumps(body['response_format']))
+        output = STRUCTURED_COMPLETION if variant == 'structured' else LEGACY_COMPLETION
+        output_tokens = count_tokens(output if isinstance(output, str) else json.dumps(output, separators=(',', ':')))
+        return {
+            'variant': variant,
+            'tokenizer': tokenizer,
+            'requests': len(sentences),
+            'mean_input_tokens': input_tokens / len(sentences),
+            'static_prompt_tokens': count_tokens(FakeChatCompletions.requests[0]['messages'][0]['content']),
+            'mean_output_tokens': output_tokens,
+            'parse_failures': failures,
+            'mean_round_trip_ms': elapsed / len(sentences) * 1000,
+        }
+
+    def legacy_extract(sentence):
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        completion = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": LEGACY_EXTRACTION_PROMPT},
+                {"role": "user", "content": sentence},
+            ],
+        )
+        return json.loads(completion.choices[0].message.content)
+
+    try:
+        return [run('legacy', legacy_extract), run('structured', recommender.extract_tags_from_input)]
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Data-scale benchmarks for the movie recommender.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help='time ingest and document-building stages at several scales')
+    ingest.add_argument('--scales', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    ingest.add_argument('--workdir', default='benchmarks_data')
+    ingest.add_argument('--output', default='benchmarks_ingest.jsonl', help='JSONL file to append results to')
+    ingest.add_argument('--with-index', action='store_true', help='also time add_movies_to_index (needs Marqo running)')
+    ingest.add_argument('--seed', type=int, default=42)
+
+    subparsers.add_parser('llm', help='compare tag extraction token counts against a local fake LLM endpoint')
+
+    args = parser.parse_args()
+    if args.command == 'ingest':
+        stages = INGEST_STAGES + (['add_movies_to_index'] if args.with_index else [])
+        results = benchmark_ingest(sorted(args.scales), args.workdir, stages, args.seed)
+        with open(args.output, 'a', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+        flagged = find_superlinear(results)
+        print()
+        for stage, scale_from, scale_to, exponent in flagged:
+            print(f"SUPERLINEAR: {stage} grows as rows^{exponent:.2f} between {scale_from} and {scale_to} movies")
+        if not flagged:
+            print("No superlinear stages found.")
+    elif args.command == 'llm':
+        sentences = [sentence for sentence in USER_REQUESTS if sentence.strip() and sentence != '---']
+        results = benchmark_llm(sentences)
+        print(f"Tokenizer: {results[0]['tokenizer']}, {len(sentences)} requests")
+        for result in results:
+            print(f"  {result['variant']:<11} input {result['mean_input_tokens']:>7.1f} "
+                  f"(static prompt {result['static_prompt_tokens']}), output {result['mean_output_tokens']:>5}, "
+                  f"parse failures {result['parse_failures']}, {result['mean_round_trip_ms']:.1f} ms/request")
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,12 @@ LOGS_DIR = 'logs'
 LOG_FILES = {
     'db' : f'{LOGS_DIR}/db.log',
 }
+# Per-request profiles, see profiling.py
+PROFILES_DIR = 'profiles'
+PROFILE_SAMPLE_INTERVAL = 0.001
+PROFILE_TOP_N = 25
+# Newest profiles kept in PROFILES_DIR; older ones are deleted
+PROFILES_KEEP = 100
 USER_REQUESTS = [
     "A Christopher Nolan thriller movie",
     "A movie on drug addiction",
@@ -45,7 +51,36 @@ USER_REQUESTS = [
 
 ]
 DB_LOCATION='sqlite:///movies.db'
+SNAPSHOT_LOCATION='movies.snapshot'
 
 NUM_SEARCH_RESULTS = 5
 
-GENRES="Drama, War, Animation, Mystery, Fantasy, Children, Documentary, Film-Noir, Sci-Fi, Adventure, Horror, Western, Action, Crime, Comedy, Musical, Romance, Thriller."
\ No newline at end of file
+# Seconds each upstream may take per call, and all upstream calls of a request together
+UPSTREAM_TIMEOUTS = {
+    'openai': 8.0,
+    'marqo': 2.0,
+    # Marqo bulk searches: this plus BULK_SEARCH_SECONDS_PER_QUERY per search
+    'marqo_bulk': 2.0,
+    'tmdb': 3.0,
+}
+REQUEST_BUDGET = 15.0
+# Calls each upstream may have running at once, including abandoned ones still
+# waiting on their client timeout. Further calls are rejected immediately, so
+# one stalled upstream cannot hold the threads the others need.
+UPSTREAM_CONCURRENCY = {
+    'openai': 16,
+    'marqo': 16,
+    'marqo_bulk': 4,
+    'tmdb': 32,
+}
+# Start a second search if Marqo has not answered after this many seconds. None disables hedging.
+SEARCH_HEDGE_AFTER = 0.5
+
+# Batch recommendations: parallel tag extractions, and searches per Marqo bulk request
+BATCH_CONCURRENCY = 8
+BULK_SEARCH_SIZE = 50
+BULK_SEARCH_SECONDS_PER_QUERY = 0.1
+BATCH_MAX_QUERIES = 1000
+
+GENRES="Drama, War, Animation, Mystery, Fantasy, Children, Documentary, Film-Noir, Sci-Fi, Adventure, Horror, Western, Action, Crime, Comedy, Musical, Romance, Thriller."
+GENRE_LIST = [genre.strip() for genre in GENRES.rstrip('.').split(',')]
@@ -1,11 +1,43 @@
 from datetime import datetime, timezone
 import logging
+import re
+import threading
 from typing import Any, Dict, List
 import pandas as pd
-from sqlalchemy import create_engine, select,func
+from sqlalchemy import JSON, bindparam, create_engine, delete, insert, select, text, func
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
 from config import CSV_FILES, DB_LOCATION, LOG_FILES
-from models import Actor, Base, Keyword, Link, Movie, Genre
+from models import Actor, Base, Keyword, Link, Movie, MovieDocument, Genre
+from resilience import remaining_budget
+from snapshot import get_snapshot, write_snapshot
+
+# Number of documents streamed and inserted per batch when building search documents.
+DOCUMENT_BATCH_SIZE = 500
+# Number of movies refreshed per statement. The aggregation binds the ids in
+# four IN (...) lists, so 4 x 200 = 800 stays below SQLite's legacy limit of
+# 999 bound parameters.
+REFRESH_BATCH_SIZE = 200
+# SQLite virtual machine steps between request budget checks in local_search
+SEARCH_PROGRESS_STEPS = 10000
+
+# Full-text index over movie_documents.text for local_search. It is an
+# external content FTS5 table: it stores only the index and reads the text
+# from movie_documents, and build_movie_documents keeps it in step.
+SEARCH_INDEX_DDL = """CREATE VIRTUAL TABLE IF NOT EXISTS movie_documents_fts USING fts5(
+    text, content='movie_documents', content_rowid='movie_id',
+    tokenize='unicode61 remove_diacritics 0')"""
+REBUILD_SEARCH_INDEX = text("INSERT INTO movie_documents_fts(movie_documents_fts) VALUES ('rebuild')")
+UNINDEX_DOCUMENTS = text(
+    "INSERT INTO movie_documents_fts(movie_documents_fts, rowid, text) "
+    "SELECT 'delete', movie_id, text FROM movie_documents WHERE movie_id IN :movie_ids"
+).bindparams(bindparam('movie_ids', expanding=True))
+INDEX_DOCUMENTS = text(
+    "INSERT INTO movie_documents_fts(rowid, text) "
+    "SELECT movie_id, text FROM movie_documents WHERE movie_id IN :movie_ids"
+).bindparams(bindparam('movie_ids', expanding=True))
+_search_index_ready = set()
+_search_index_lock = threading.Lock()
 
 def create_logger():
     logger = logging.getLogger(__name__)
@@ -22,6 +54,13 @@ def create_logger():
 def init_db(location=DB_LOCATION):
     engine = create_engine(location)
     Base.metadata.create_all(engine)
+    # create_all skips indexes of tables that already exist, e.g. the movie_id
+    # indexes added after a database was first created
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        create_search_index(connection)
     
     logger = create_logger()
     logger.info("Database created successfully")
@@ -44,6 +83,10 @@ def load_data(engine):
             logger.info("Actors loaded successfully")
             load_links_from_csv(session, CSV_FILES['links'])
             logger.info("Links loaded successfully")
+            build_movie_documents(session)
+            logger.info("Movie documents built successfully")
+            write_snapshot(session)
+            logger.info("Catalog snapshot written successfully")
         except Exception as e:
             print(f"Error loading data: {e}")
 
@@ -173,31 +216,37 @@ def load_links_from_csv(session, csv_path):
     session.commit()
 
 # function to get movie id, title, keywords, genres, actors and director
-def get_relevant_movie_fields(session):
-    genre_subq = (
+# If movie_ids is given, only those movies are aggregated.
+def get_relevant_movie_fields(session, movie_ids=None):
+    genre_select = (
         select(
             Movie.id,
             func.group_concat(Genre.genre_name, ' ').label('genres')
         ) 
         .join(Movie.genres)
         .group_by(Movie.id)
-        .subquery()
     )
-    keyword_subq = (
+    keyword_select = (
         select(
             Keyword.movie_id,
             Keyword.keywords
         )
-        .subquery()
     )
-    actor_subq = (
+    actor_select = (
         select(
             Actor.movie_id,
             func.group_concat(Actor.actor_name, ',').label('actors')
         )
         .group_by(Actor.movie_id)
-        .subquery()
     )
+    if movie_ids is not None:
+        genre_select = genre_select.where(Movie.id.in_(movie_ids))
+        keyword_select = keyword_select.where(Keyword.movie_id.in_(movie_ids))
+        actor_select = actor_select.where(Actor.movie_id.in_(movie_ids))
+
+    genre_subq = genre_select.subquery()
+    keyword_subq = keyword_select.subquery()
+    actor_subq = actor_select.subquery()
 
     query = (
         select(
@@ -214,23 +263,245 @@ def get_relevant_movie_fields(session):
         .join(keyword_subq, Movie.id == keyword_subq.c.movie_id, isouter=True)
         .join(actor_subq, Movie.id == actor_subq.c.movie_id, isouter=True)
     )    
+    if movie_ids is not None:
+        query = query.where(Movie.id.in_(movie_ids))
+    else:
+        # Full rebuilds stream the single aggregation in primary key order
+        query = query.order_by(Movie.id).execution_options(yield_per=DOCUMENT_BATCH_SIZE)
 
     return session.execute(query)
 
 
+def create_search_index(connection):
+    """Create the full-text index of movie_documents if it does not exist yet.
+
+    An index added to a database that already has documents is filled from
+    them. connection is a Connection or Session; the caller commits.
+    """
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'movie_documents_fts'")).first() is not None
+    if not exists:
+        connection.execute(text(SEARCH_INDEX_DDL))
+        connection.execute(REBUILD_SEARCH_INDEX)
+
+def build_movie_documents(session, movie_ids=None):
+    """Build or refresh rows of the denormalised movie_documents table.
+
+    A full rebuild runs the genre/keyword/actor aggregation once over the whole
+    catalog and streams it into the table. A refresh aggregates only the given
+    movies, REFRESH_BATCH_SIZE at a time. The full-text index is rebuilt
+    after a full rebuild and updated row by row for a refresh.
+
+    Args:
+        session (Session): SQLAlchemy session object
+        movie_ids (Iterable[int], optional): Movies whose source rows changed.
+            Only these documents are rebuilt. If None, every movie is rebuilt.
+
+    Returns:
+        int: Number of documents written
+    """
+    create_search_index(session)
+    if movie_ids is None:
+        # Full rebuild: also drop documents of movies that no longer exist
+        session.execute(delete(MovieDocument))
+        batches = get_relevant_movie_fields(session).partitions()
+    else:
+        movie_ids = sorted(set(int(movie_id) for movie_id in movie_ids))
+        batches = (movie_ids[i:i + REFRESH_BATCH_SIZE] for i in range(0, len(movie_ids), REFRESH_BATCH_SIZE))
+
+    written = 0
+    for batch in batches:
+        if movie_ids is None:
+            documents = format_movies(batch)
+        else:
+            session.execute(UNINDEX_DOCUMENTS, {'movie_ids': batch})
+            session.execute(delete(MovieDocument).where(MovieDocument.movie_id.in_(batch)))
+            documents = format_movies(get_relevant_movie_fields(session, batch))
+        if documents:
+            session.execute(insert(MovieDocument), [
+                {
+                    "movie_id": int(document["id"]),
+                    "text": document["text"],
+                    "title": document["title"],
+                    "genres": document["genres"],
+                    "actors": document["actors"],
+                    "director": document["director"],
+                    "year": document["year"],
+                    "popularity": document["popularity"]
+                }
+                for document in documents
+            ])
+            if movie_ids is not None:
+                session.execute(INDEX_DOCUMENTS, {'movie_ids': batch})
+        written += len(documents)
+
+    if movie_ids is None:
+        session.execute(REBUILD_SEARCH_INDEX)
+    session.commit()
+    return written
+
+def refresh_movie_documents(movie_ids=None):
+    """Rebuild the search documents of changed movies in the default database.
+
+    The catalog snapshot cannot be patched in place, so it is rewritten in
+    full; workers pick up the new file on their next get_snapshot call. This
+    costs a full catalog scan per call (about 0.45s for 10k movies), so
+    refresh many edited movies with one call rather than one call each.
+    """
+    engine = create_engine(DB_LOCATION)
+    Base.metadata.create_all(engine)
+
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        written = build_movie_documents(session, movie_ids)
+        write_snapshot(session)
+    return written
+
+def iter_movie_documents(session, batch_size=DOCUMENT_BATCH_SIZE):
+    """Stream movie documents from the movie_documents table in primary key order.
+
+    Yields documents in the structure added to the Marqo index, e.g.
+    {"id": "1", "text": "Toy Story rescue ...", "title": "Toy Story",
+     "genres": ["Adventure", ...], "actors": ["Tom Hanks", ...], ...}
+    """
+    query = (
+        select(
+            MovieDocument.movie_id,
+            MovieDocument.text,
+            MovieDocument.title,
+            MovieDocument.genres,
+            MovieDocument.actors,
+            MovieDocument.director,
+            MovieDocument.year,
+            MovieDocument.popularity
+        )
+        .order_by(MovieDocument.movie_id)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in session.execute(query):
+        yield {
+            "id": str(row.movie_id),
+            "text": row.text,
+            "title": row.title,
+            "genres": row.genres,
+            "actors": row.actors,
+            "director": row.director,
+            "year": row.year,
+            "popularity": row.popularity
+        }
+
+_FILTER_CLAUSE = re.compile(r'(NOT )?genres IN \(([^)]*)\)|actors:\(([^)]*)\)')
+_WORD = re.compile(r'[^\W_]+')
+
+def _search_engine(location=DB_LOCATION):
+    """Engine for local_search, with the full-text index created on first use."""
+    engine = create_engine(location)
+    if location not in _search_index_ready:
+        with _search_index_lock:
+            if location not in _search_index_ready:
+                with engine.begin() as connection:
+                    create_search_index(connection)
+                _search_index_ready.add(location)
+    return engine
+
+def local_search(user_keywords, filter, limit=10):
+    """Search the movie_documents table without Marqo, for when it is unavailable.
+
+    Understands the filter strings built by main.construct_user_query and
+    scores movies by the number of query words found in their text field,
+    using the movie_documents_fts index. The query is interrupted when the
+    request budget runs out, returning no hits. Returns results in the same
+    shape as a Marqo search.
+    """
+    logger = logging.getLogger(__name__)
+    required_genres, excluded_genres, required_actors = [], [], []
+    for negated, genre, actor in _FILTER_CLAUSE.findall(filter or ''):
+        if actor:
+            required_actors.append(actor)
+        elif negated:
+            excluded_genres.append(genre)
+        else:
+            required_genres.append(genre)
+    query_words = sorted(set(_WORD.findall((user_keywords or '').lower())))
+
+    params = {'limit': limit}
+    conditions = []
+    for i, genre in enumerate(required_genres):
+        conditions.append(f"EXISTS (SELECT 1 FROM json_each(d.genres) WHERE value = :genre{i})")
+        params[f'genre{i}'] = genre
+    for i, genre in enumerate(excluded_genres):
+        conditions.append(f"NOT EXISTS (SELECT 1 FROM json_each(d.genres) WHERE value = :excluded{i})")
+        params[f'excluded{i}'] = genre
+    for i, actor in enumerate(required_actors):
+        conditions.append(f"EXISTS (SELECT 1 FROM json_each(d.actors) WHERE value = :actor{i})")
+        params[f'actor{i}'] = actor
+    # The score counts the query words in the text; each word is one indexed lookup
+    matches = []
+    for i, word in enumerate(query_words):
+        matches.append(f"(d.movie_id IN (SELECT rowid FROM movie_documents_fts WHERE movie_documents_fts MATCH :word{i}))")
+        params[f'word{i}'] = f'"{word}"'
+    if query_words:
+        conditions.append("d.movie_id IN (SELECT rowid FROM movie_documents_fts WHERE movie_documents_fts MATCH :any_word)")
+        params['any_word'] = ' OR '.join(f'"{word}"' for word in query_words)
+    query = text(f"""
+        SELECT d.movie_id, d.text, d.title, d.genres, d.actors, d.director, d.year, d.popularity,
+               {' + '.join(matches) or '0'} AS score
+        FROM movie_documents AS d
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY score DESC, COALESCE(d.popularity, 0) DESC
+        LIMIT :limit""").columns(genres=JSON, actors=JSON)
+
+    remaining = remaining_budget()
+    if remaining is not None and remaining <= 0:
+        logger.warning("No request budget left for a local search")
+        return {"hits": []}
+    engine = _search_engine()
+    with engine.connect() as connection:
+        sqlite_connection = connection.connection.dbapi_connection
+        if remaining is not None:
+            # A non-zero return value interrupts the running statement
+            sqlite_connection.set_progress_handler(lambda: remaining_budget() <= 0, SEARCH_PROGRESS_STEPS)
+        try:
+            rows = connection.execute(query, params).all()
+        except OperationalError as e:
+            if remaining_budget() is None or remaining_budget() > 0:
+                raise
+            logger.warning(f"Local search stopped at the end of the request budget: {e.orig}")
+            return {"hits": []}
+        finally:
+            sqlite_connection.set_progress_handler(None, 0)
+
+    return {"hits": [
+        {
+            "id": str(row.movie_id),
+            "text": row.text,
+            "title": row.title,
+            "genres": row.genres,
+            "actors": row.actors,
+            "director": row.director,
+            "year": row.year,
+            "popularity": row.popularity,
+            "_score": float(row.score),
+        }
+        for row in rows
+    ]}
+
 def get_movies_as_documents():
+    """Yield every movie document of the default database, see iter_movie_documents.
+
+    Documents are streamed, so a consumer that handles them in batches never
+    holds the whole catalog in memory.
+    """
     engine = create_engine(DB_LOCATION)
     Base.metadata.create_all(engine)
 
     Session = sessionmaker(bind=engine)
-    # session = Session()
     with Session() as session:
-        # movies_with_title_genres_tags = get_movies_with_title_genres_tags(session)
-        relevant_movie_fields = get_relevant_movie_fields(session)
-        # Format results into structure required to be added to Marqo index
-        # Combine title, genres and tags into a single field to be indexed
-        # Example: [{"id": "1", "title_genres_tags": "Toy Story Animation Children's", "title": "Toy Story", "genres": ["Animation", "Children's"], "tags": []}]
-        return format_movies(relevant_movie_fields)
+        # Documents are materialised by load_data; build them here for
+        # databases loaded before the movie_documents table existed.
+        if session.scalar(select(func.count()).select_from(MovieDocument)) == 0:
+            build_movie_documents(session)
+        yield from iter_movie_documents(session)
 
 def format_movies(results)-> List[Dict[str, Any]]:
     """Format database results into movie documents for search indexing.
@@ -279,6 +550,7 @@ def format_movies(results)-> List[Dict[str, Any]]:
             genres = movie.genres.split(" ")
             vector_field+= " "+movie.genres
         actors =[]
+        director = None
         if(movie.actors):
             actors = movie.actors.split(",")
             vector_field+= " "+movie.actors
@@ -300,6 +572,16 @@ def format_movies(results)-> List[Dict[str, Any]]:
     return formatted_movies
     
 def attach_imdb_links(recommendations):
+    snapshot = get_snapshot()
+    if snapshot:
+        for movie in recommendations:
+            row = snapshot.row_of(int(movie['id']))
+            if row is not None and snapshot.imdb_id(row) is not None:
+                imdbID = f"{snapshot.imdb_id(row):07d}"
+                movie['imdb_id'] = imdbID
+                movie['imdb_url'] = 'https://www.imdb.com/title/tt' + imdbID
+        return recommendations
+
     engine = create_engine(DB_LOCATION)
     Base.metadata.create_all(engine)
 
@@ -324,6 +606,14 @@ def attach_imdb_links(recommendations):
             return []
 
 def attach_posters(recommendations):
+    snapshot = get_snapshot()
+    if snapshot:
+        for movie in recommendations:
+            row = snapshot.row_of(int(movie['id']))
+            if row is not None and snapshot.poster_path(row):
+                movie['poster_url'] = "https://image.tmdb.org/t/p/w200"+snapshot.poster_path(row)
+        return recommendations
+
     engine = create_engine(DB_LOCATION)
     Base.metadata.create_all(engine)
 
@@ -346,6 +636,15 @@ def attach_posters(recommendations):
             return []
         
 def attach_ratings_overviews(recommendations):
+    snapshot = get_snapshot()
+    if snapshot:
+        for movie in recommendations:
+            row = snapshot.row_of(int(movie['id']))
+            if row is not None:
+                movie['rating'] = snapshot.popularities[row]
+                movie['plot'] = snapshot.overview(row)
+        return recommendations
+
     engine = create_engine(DB_LOCATION)
     Base.metadata.create_all(engine)
 
@@ -366,4 +665,39 @@ def attach_ratings_overviews(recommendations):
             return recommendations
         except Exception as e:
             print(f"Error adding ratings and overviews: {e}")
-            return []
\ No newline at end of file
+            return []
+
+def attach_movie_details(recommendations):
+    """Attach IMDb links, posters, ratings and plots with one query for all recommendations.
+
+    Used for batches, where calling the attach_* helpers per request would
+    repeat the lookups for every query.
+    """
+    movie_ids = sorted({int(movie['id']) for movie in recommendations})
+    if not movie_ids:
+        return recommendations
+
+    engine = create_engine(DB_LOCATION)
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        # Ids are rendered inline, so large batches do not hit SQLite's bound-parameter limit
+        query = (
+            select(Movie.id, Movie.popularity, Movie.overview, Link.imdb_id, Link.poster_path)
+            .join(Link, Link.movie_id == Movie.id, isouter=True)
+            .where(Movie.id.in_(bindparam('movie_ids', expanding=True, literal_execute=True)))
+        )
+        details = {row.id: row for row in session.execute(query, {'movie_ids': movie_ids})}
+
+    for movie in recommendations:
+        row = details.get(int(movie['id']))
+        if row is None:
+            continue
+        if row.imdb_id is not None:
+            imdbID = f"{row.imdb_id:07d}"
+            movie['imdb_id'] = imdbID
+            movie['imdb_url'] = 'https://www.imdb.com/title/tt' + imdbID
+        if row.poster_path:
+            movie['poster_url'] = "https://image.tmdb.org/t/p/w200"+row.poster_path
+        movie['rating'] = row.popularity
+        movie['plot'] = row.overview
+    return recommendations
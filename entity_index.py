@@ -0,0 +1,246 @@
+# In-memory fuzzy entity resolution for actors, directors and titles.
+# Names from the LLM ("jack nicholson", "Chris Nolan", "The Matrix") are mapped
+# to the spelling stored in the catalog ("Jack Nicholson", "Christopher Nolan",
+# "Matrix, The") by character-trigram similarity, so filters and queries match.
+from collections import Counter
+from dataclasses import dataclass
+import math
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from config import DB_LOCATION
+from models import Actor, Base, Movie
+
+ACTOR = 'actor'
+DIRECTOR = 'director'
+TITLE = 'title'
+
+# Dice similarity below which a name is not considered a match
+MIN_SIMILARITY = 0.5
+# Stricter bounds for rewriting a name into a filter or title (see resolve):
+# the best match must score this high and lead the best differently named
+# match by REWRITE_MARGIN. Below that, similar names are usually different
+# people or movies ("Florence Pugh" vs "Florence Pernel").
+REWRITE_SIMILARITY = 0.85
+REWRITE_MARGIN = 0.05
+
+_TRAILING_ARTICLE = re.compile(r'^(.*), (the|a|an)$')
+_NON_ALPHANUMERIC = re.compile(r'[^0-9a-z]+')
+
+
+@dataclass
+class EntityMatch:
+    name: str
+    kind: str
+    score: float
+
+def normalize_name(name: str) -> str:
+    """Lowercase, strip accents and punctuation, and undo "Matrix, The" style titles."""
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char)).lower().strip()
+    article = _TRAILING_ARTICLE.match(name)
+    if article:
+        name = f"{article.group(2)} {article.group(1)}"
+    return _NON_ALPHANUMERIC.sub(' ', name).strip()
+
+def trigrams(normalized: str) -> frozenset:
+    padded = f" {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class EntityIndex:
+    """Character-trigram index mapping noisy names to canonical catalog entities.
+
+    Names are scored by the Dice similarity of their trigram sets, or by token
+    prefixes for abbreviated first names, whichever is higher.
+
+    Example:
+        >>> index = EntityIndex()
+        >>> index.add('Christopher Nolan', DIRECTOR, weight=11)
+        >>> index.best('Chris Nolan', DIRECTOR)
+        EntityMatch(name='Christopher Nolan', kind='director', score=0.95)
+    """
+
+    def __init__(self):
+        self._names: List[str] = []
+        self._kinds: List[str] = []
+        self._weights: List[float] = []
+        self._trigrams: List[frozenset] = []
+        self._tokens: List[tuple] = []
+        # One and two letter prefixes of each entity's tokens, to skip the
+        # token prefix score for entities it cannot match
+        self._token_starts: List[frozenset] = []
+        self._exact: Dict[tuple, int] = {}
+        self._postings: Dict[tuple, List[int]] = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name: str, kind: str, weight: float = 1.0):
+        """Add an entity. Spellings that normalize the same keep the heaviest one."""
+        normalized = normalize_name(name)
+        if not normalized:
+            return
+        existing = self._exact.get((kind, normalized))
+        if existing is not None:
+            if weight > self._weights[existing]:
+                self._names[existing] = name
+                self._weights[existing] = weight
+            return
+
+        entity_id = len(self._names)
+        grams = trigrams(normalized)
+        self._names.append(name)
+        self._kinds.append(kind)
+        self._weights.append(weight)
+        self._trigrams.append(grams)
+        self._tokens.append(tuple(normalized.split()))
+        self._token_starts.append(frozenset(token[:length] for token in normalized.split() for length in (1, 2)))
+        self._exact[(kind, normalized)] = entity_id
+        for gram in grams:
+            self._postings.setdefault((kind, gram), []).append(entity_id)
+
+    def lookup(self, query: str, kinds=(ACTOR, DIRECTOR, TITLE), limit: int = 5,
+               min_score: float = MIN_SIMILARITY) -> List[EntityMatch]:
+        """Return up to limit matches for query, best first.
+
+        Args:
+            query (str): Name as written by the user or the LLM
+            kinds (Iterable[str]): Entity kinds to search
+            limit (int): Maximum number of matches
+            min_score (float): Minimum Dice similarity of trigram sets, 0 to 1
+
+        Returns:
+            List[EntityMatch]: Matches sorted by score, then by the order of
+                their kind in kinds, then by weight
+        """
+        normalized = normalize_name(query or '')
+        if not normalized:
+            return []
+        if isinstance(kinds, str):
+            kinds = (kinds,)
+        kind_rank = {kind: rank for rank, kind in enumerate(kinds)}
+
+        exact = [self._exact[(kind, normalized)] for kind in kinds if (kind, normalized) in self._exact]
+        if exact:
+            return [EntityMatch(self._names[i], self._kinds[i], 1.0) for i in exact][:limit]
+
+        query_grams = trigrams(normalized)
+        query_tokens = normalized.split()
+        query_starts = frozenset(token[:2] for token in query_tokens)
+        # A match with Dice >= min_score shares at least min_overlap trigrams with
+        # the query, so it shares at least one of the query's
+        # len(query_grams) - min_overlap + 1 rarest trigrams. Only the postings
+        # of those are scanned for candidates; the common trigrams, whose
+        # postings are the longest, are checked per candidate instead.
+        min_overlap = max(1, math.ceil(min_score * len(query_grams) / (2 - min_score)))
+        scored = {}
+        for kind in kinds:
+            by_rarity = sorted(query_grams, key=lambda gram: len(self._postings.get((kind, gram), ())))
+            rare, common = by_rarity[:len(by_rarity) - min_overlap + 1], frozenset(by_rarity[len(by_rarity) - min_overlap + 1:])
+            overlaps = Counter()
+            for gram in rare:
+                overlaps.update(self._postings.get((kind, gram), ()))
+            for entity_id, overlap in overlaps.items():
+                if common:
+                    overlap += len(common & self._trigrams[entity_id])
+                if overlap < min_overlap:
+                    continue
+                score = 2 * overlap / (len(query_grams) + len(self._trigrams[entity_id]))
+                if score < 0.95 and query_starts <= self._token_starts[entity_id]:
+                    score = max(score, self._token_prefix_score(query_tokens, entity_id))
+                if score >= min_score:
+                    scored[entity_id] = score
+
+        best = sorted(scored, key=lambda i: (-scored[i], kind_rank[self._kinds[i]], -self._weights[i]))[:limit]
+        return [EntityMatch(self._names[i], self._kinds[i], scored[i]) for i in best]
+
+    def _token_prefix_score(self, query_tokens, entity_id):
+        """Score abbreviated names such as "Chris Nolan" for "Christopher Nolan".
+
+        Each query token must be a prefix of a distinct entity token, in order.
+        Kept just below 1.0 so exact spellings still rank first.
+        """
+        entity_tokens = self._tokens[entity_id]
+        position = 0
+        for token in query_tokens:
+            while position < len(entity_tokens) and not entity_tokens[position].startswith(token):
+                position += 1
+            if position == len(entity_tokens):
+                return 0.0
+            position += 1
+        return 0.95 * len(query_tokens) / max(len(query_tokens), len(entity_tokens))
+
+    def best(self, query: str, kinds=(ACTOR, DIRECTOR, TITLE),
+             min_score: float = MIN_SIMILARITY) -> Optional[EntityMatch]:
+        """Return the single best match for query, or None."""
+        matches = self.lookup(query, kinds, limit=1, min_score=min_score)
+        return matches[0] if matches else None
+
+    def resolve(self, query: str, kinds=(ACTOR, DIRECTOR, TITLE), min_score: float = REWRITE_SIMILARITY,
+                margin: float = REWRITE_MARGIN) -> Optional[EntityMatch]:
+        """Return the match query can safely be rewritten to, or None.
+
+        Exact spellings always resolve, to the first of kinds they exist in.
+        Fuzzy matches must score at least min_score and beat the best match
+        with a different name by margin.
+        """
+        if isinstance(kinds, str):
+            kinds = (kinds,)
+        # The same name can match once per kind, so this finds a differently named runner-up
+        matches = self.lookup(query, kinds, limit=len(kinds) + 1, min_score=min(min_score, MIN_SIMILARITY))
+        if not matches or matches[0].score < min_score:
+            return None
+        best = matches[0]
+        if best.score < 1.0:
+            runner_up = next((match for match in matches[1:] if match.name != best.name), None)
+            if runner_up is not None and best.score - runner_up.score < margin:
+                return None
+        return best
+
+def build_entity_index(session) -> EntityIndex:
+    """Build an index of every actor, director and title in the database.
+
+    Actors and directors are weighted by their number of movies and titles by
+    popularity, which breaks ties between equally similar names.
+    """
+    index = EntityIndex()
+    actor_query = select(Actor.actor_name, func.count()).group_by(Actor.actor_name)
+    for name, movie_count in session.execute(actor_query):
+        index.add(name, ACTOR, movie_count)
+
+    director_query = (
+        select(Movie.director, func.count())
+        .where(Movie.director.is_not(None))
+        .group_by(Movie.director)
+    )
+    for name, movie_count in session.execute(director_query):
+        index.add(name, DIRECTOR, movie_count)
+
+    for title, popularity in session.execute(select(Movie.title, Movie.popularity)):
+        index.add(title, TITLE, popularity or 0.0)
+    return index
+
+_entity_index = None
+_entity_index_lock = threading.Lock()
+
+def get_entity_index() -> EntityIndex:
+    """Return the process-wide entity index, building it on first use.
+
+    Concurrent first callers wait for a single build.
+    """
+    global _entity_index
+    if _entity_index is None:
+        with _entity_index_lock:
+            if _entity_index is None:
+                engine = create_engine(DB_LOCATION)
+                Base.metadata.create_all(engine)
+
+                Session = sessionmaker(bind=engine)
+                with Session() as session:
+                    _entity_index = build_entity_index(session)
+    return _entity_index
@@ -1,18 +1,31 @@
-from dataclasses import dataclass
+import argparse
+import asyncio
+from dataclasses import dataclass, replace
+from enum import Enum
 import json
 import logging
 from openai import OpenAI
 import os
-from pydantic import Field, ValidationError, BaseModel
+import re
+from pydantic import ConfigDict, Field, ValidationError, BaseModel
 from typing import List, Literal, Optional, Tuple
 
-from config import GENRES, NUM_SEARCH_RESULTS, USER_REQUESTS
-from vectordb import search_movies
+from config import BATCH_CONCURRENCY, GENRE_LIST, NUM_SEARCH_RESULTS, SEARCH_HEDGE_AFTER, UPSTREAM_TIMEOUTS, USER_REQUESTS
+from database import local_search
+from entity_index import ACTOR, DIRECTOR, TITLE, get_entity_index
+from profiling import profile_request, profiling_requested
+from resilience import UPSTREAMS, UpstreamError, request_budget
+from singleflight import SingleFlight, normalize_input
+from vectordb import cached_search, search_movies
 
  # Setup logging
 logging.basicConfig(filename='runs.log', encoding='utf-8', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Concurrent identical requests share one LLM call and one search
+extraction_flight = SingleFlight('extract_tags')
+search_flight = SingleFlight('search')
+
 @dataclass
 class UserPreferences:
     title: Optional[str]
@@ -20,61 +33,269 @@ class UserPreferences:
     actors: List[Tuple[str, int]]
     era: Optional[str]
     keywords: List[str]
+    # 'llm', or a fallback: 'local' (keyword parse) or 'sentence' (unusable LLM output)
+    source: str = 'llm'
+
+# Static system prompt. It is byte-identical on every call and the user's
+# sentence only appears in the user message, so the prefix is cacheable.
+# The genre list travels in the response schema instead.
+EXTRACTION_PROMPT = """Extract the user's movie preferences.
+title: only a real movie title the user names.
+genres, actors: those the user wants. excluded_genres, excluded_actors: those they do not want.
+era: only if mentioned.
+keywords: other themes or qualities mentioned, as short phrases.
+Do not infer anything."""
+
+EXTRACTION_MODEL = "gpt-4o-mini"
+EXTRACTION_MAX_TOKENS = 200
+
+Genre = Enum('Genre', {genre: genre for genre in GENRE_LIST}, type=str)
+
+# Structured output schema of the tag extraction. Wanted and unwanted names are
+# separate lists rather than [name, flag] pairs, which keeps the schema simple
+# for strict mode at about the same number of output tokens.
+class MovieTags(BaseModel):
+    model_config = ConfigDict(extra='forbid')
+    title: Optional[str]
+    genres: List[Genre]
+    excluded_genres: List[Genre]
+    actors: List[str]
+    excluded_actors: List[str]
+    era: Optional[Literal['recent', 'old']]
+    keywords: List[str]
 
-    @classmethod
-    def from_json(cls, data: dict) -> 'UserPreferences':
-        return cls(
-            title=data.get('title'),
-            genres=data.get('genres', []),
-            actors=data.get('actors', []),
-            era=data.get('era'),
-            keywords=data.get('keywords', [])
+    def to_preferences(self) -> UserPreferences:
+        return UserPreferences(
+            title=self.title,
+            genres=[(genre.value, 1) for genre in self.genres] + [(genre.value, 0) for genre in self.excluded_genres],
+            actors=[(actor, 1) for actor in self.actors] + [(actor, 0) for actor in self.excluded_actors],
+            era=self.era,
+            keywords=self.keywords
         )
-    
-def extract_tags_from_input(input_sentence: str) -> str:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    # prompt1 = "Extract the tags. Do not infer any information. Include title only if it is a valid movie name."
-    prompt = f'''Act as a specialized assistant who extracts tags from user input. The user will input a sentence describing the kind of movie they would like to watch. Extract the following tags from the input:
-1. Movie Title: Also decide if the user wants to watch something similar to this movie or not.
-2. Actors: Extract a list of actors if mentioned. For each actor specify whether the user would like that actor to be in the movie or not.
-3. Genres: Extract a list of genres if mentioned. Each genre should be one of the following values: 
-      ```{GENRES}```
-For each genre specify whether the user would like to watch a movie of that genre or not. 
-4. Era: If mentioned, include the era of the desired movie. Output one of two values, 'recent' or 'old'.
-5. Keywords: Any other relevant keywords mentioned by the user.
-
-Output the extracted tags in the JSON format as shown in the examples below. 
-Examples:
-1. User input: "I want to watch a action movie, but not a comedy, starring Tom Cruise. The movie should have good dialogues and a twist in the ending. I do not want to watch a Penelope Cruz movie."
-   Output: {{
-                     "title": null
-                     "genres": [["action", 1], ["comedy", 0]]
-                     "actors": [["Tom Cruise", 1], ["Penelope Cruz", 0]] 
-                     "era": null
-                     "keywords": ["good dialogues", "twist in the ending"]
-                     }}
-
-2. User input: "I want to watch an old dramatic musical. The movie should have great music and should be inspiring. "
-   Output: {{
-                     "title": null
-                     "genres": [["musical", 1], ["drama", 1]]
-                     "actors": null 
-                     "era": "old"
-                     "keywords": ["great music", "inspiring"]
-                     }}
-
-Do not infer any information. Include a title only if it is a valid movie name.
-'''
-    completion = client.beta.chat.completions.parse(
-        model="gpt-4o-mini",
+
+def compact_schema(schema):
+    """Drop the "title" annotations pydantic adds, which only cost prompt tokens."""
+    if isinstance(schema, dict):
+        return {key: compact_schema(value) for key, value in schema.items()
+                if not (key == 'title' and isinstance(value, str))}
+    if isinstance(schema, list):
+        return [compact_schema(value) for value in schema]
+    return schema
+
+MOVIE_TAGS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "movie_tags", "strict": True, "schema": compact_schema(MovieTags.model_json_schema())},
+}
+
+def extract_tags_from_input(input_sentence: str) -> UserPreferences:
+    # Retries are left to the circuit breaker and the local fallback
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=UPSTREAM_TIMEOUTS['openai'], max_retries=0)
+    completion = client.chat.completions.create(
+        model=EXTRACTION_MODEL,
         messages=[
-            {"role": "system", "content": prompt},
+            {"role": "system", "content": EXTRACTION_PROMPT},
             {"role": "user", "content": input_sentence},
         ],
+        response_format=MOVIE_TAGS_RESPONSE_FORMAT,
+        max_tokens=EXTRACTION_MAX_TOKENS,
+        temperature=0,
+    )
+    return parse_movie_tags(completion.choices[0].message.content or '', input_sentence)
+
+def parse_movie_tags(content: str, input_sentence: str) -> UserPreferences:
+    """Validate the extraction output, with one local repair attempt.
+
+    If the output cannot be repaired, the whole sentence is searched as a
+    keyword instead of failing the request.
+    """
+    try:
+        return MovieTags.model_validate_json(content).to_preferences()
+    except ValidationError as e:
+        logger.warning(f"Invalid extraction output, repairing: {e}")
+    try:
+        return repair_movie_tags(content).to_preferences()
+    except (ValueError, ValidationError) as e:
+        logger.error(f"Could not repair extraction output {content!r}: {e}")
+        return UserPreferences(title=None, genres=[], actors=[], era=None, keywords=[input_sentence], source='sentence')
+
+def repair_movie_tags(content: str) -> MovieTags:
+    """Cheap local repair of almost valid output.
+
+    Takes the outermost JSON object, also accepts the older [["name", 1], ...]
+    pairs, fixes genre casing and drops entries that still do not fit.
+    Raises ValueError or ValidationError if nothing usable is left.
+    """
+    start, end = content.find('{'), content.rfind('}')
+    if start == -1 or end < start:
+        raise ValueError("No JSON object in output")
+    data = json.loads(content[start:end + 1])
+
+    def as_list(key):
+        # A bare string is one entry, not a sequence of characters
+        value = data.get(key)
+        if isinstance(value, str):
+            return [value]
+        return value if isinstance(value, list) else []
+
+    def split(wanted_key, excluded_key):
+        wanted, excluded = [], []
+        for item in as_list(wanted_key):
+            if isinstance(item, (list, tuple)) and item:
+                (wanted if len(item) < 2 or item[1] else excluded).append(item[0])
+            else:
+                wanted.append(item)
+        excluded.extend(as_list(excluded_key))
+        return wanted, excluded
+
+    genres_by_name = {genre.lower(): genre for genre in GENRE_LIST}
+    genres, excluded_genres = split('genres', 'excluded_genres')
+    actors, excluded_actors = split('actors', 'excluded_actors')
+    era = data.get('era')
+    tags = MovieTags.model_validate({
+        'title': data.get('title') if isinstance(data.get('title'), str) else None,
+        'genres': [genres_by_name[str(name).lower()] for name in genres if str(name).lower() in genres_by_name],
+        'excluded_genres': [genres_by_name[str(name).lower()] for name in excluded_genres
+                            if str(name).lower() in genres_by_name],
+        'actors': [name for name in actors if isinstance(name, str)],
+        'excluded_actors': [name for name in excluded_actors if isinstance(name, str)],
+        'era': era.lower() if isinstance(era, str) and era.lower() in ('recent', 'old') else None,
+        'keywords': [keyword for keyword in as_list('keywords') if isinstance(keyword, str)],
+    })
+    # Output that was invalid and left nothing after repair carried no
+    # preferences; searching the sentence itself is the better fallback
+    if not any(tags.model_dump().values()):
+        raise ValueError("Nothing usable left after repair")
+    return tags
+
+# Words the local parser maps to genres, besides the genre names themselves
+GENRE_ALIASES = {
+    'sci fi': 'Sci-Fi', 'scifi': 'Sci-Fi', 'science fiction': 'Sci-Fi', 'noir': 'Film-Noir',
+    'animated': 'Animation', 'cartoon': 'Animation', 'kids': 'Children', 'family': 'Children',
+    'funny': 'Comedy', 'comedies': 'Comedy', 'dramatic': 'Drama', 'scary': 'Horror',
+    'romantic': 'Romance', 'thrillers': 'Thriller', 'westerns': 'Western', 'musicals': 'Musical',
+    'mysteries': 'Mystery', 'documentaries': 'Documentary',
+}
+NEGATIONS = {'not', 'no', 'without', 'nothing', "isn't", "don't"}
+STOPWORDS = {
+    'a', 'an', 'the', 'i', 'want', 'to', 'watch', 'movie', 'movies', 'film', 'films', 'something',
+    'about', 'on', 'of', 'with', 'and', 'or', 'but', 'is', 'which', 'that', 'set', 'some', 'me',
+    'show', 'like', 'would', 'should', 'be', 'in', 'for', 'starring', 'featuring', 'by', 'being',
+} | NEGATIONS
+_ACTOR_CUE = re.compile(r"\b(?:starring|featuring|with|by)\s+((?:[\w'.-]+\s*){1,3})", re.IGNORECASE)
+
+def is_negated(words, position, window=5):
+    """True if a negation shortly before words[position] applies to it, as in
+    "not a romance or an animation". "but", "and" and "with" end the negation."""
+    for word in reversed(words[max(0, position - window):position]):
+        if word in NEGATIONS:
+            return True
+        if word in ('but', 'and', 'with'):
+            return False
+    return False
+
+def parse_preferences_locally(input_sentence: str) -> UserPreferences:
+    """Keyword parse of a request, used when the LLM is unavailable.
+
+    Finds genre names and common synonyms (negated after "not", "no" or
+    "without"), the era, and actor or director names after "starring",
+    "with" or "by" that resolve in the entity index. The remaining words
+    become keywords.
+    """
+    text = input_sentence.lower().replace('-', ' ')
+    words = re.findall(r"[\w']+", text)
+    names = {genre.lower().replace('-', ' '): genre for genre in GENRE_LIST}
+    names.update(GENRE_ALIASES)
+
+    genres, used = [], set()
+    for name, genre in names.items():
+        name_words = name.split()
+        for i in range(len(words) - len(name_words) + 1):
+            if words[i:i + len(name_words)] == name_words:
+                wanted = 0 if is_negated(words, i) else 1
+                if genre not in (g for g, _ in genres):
+                    genres.append((genre, wanted))
+                used.update(range(i, i + len(name_words)))
+
+    era = None
+    if {'old', 'classic', 'vintage'}.intersection(words):
+        era = 'old'
+    elif {'recent', 'new', 'modern', 'latest'}.intersection(words):
+        era = 'recent'
+
+    actors, actor_words = [], set()
+    entity_index = get_entity_index()
+    for match in _ACTOR_CUE.finditer(input_sentence):
+        candidate = match.group(1).split()
+        # Try the longest run of words that names a known person
+        for length in range(len(candidate), 1, -1):
+            entity = entity_index.resolve(' '.join(candidate[:length]), (ACTOR, DIRECTOR))
+            if entity:
+                actors.append((entity.name, 1))
+                actor_words.update(word.lower().strip(".,!?") for word in candidate[:length])
+                break
+
+    keywords = [
+        word for i, word in enumerate(words)
+        if i not in used and word not in STOPWORDS and word not in actor_words
+        and word not in ('old', 'classic', 'vintage', 'recent', 'new', 'modern', 'latest')
+    ]
+    return UserPreferences(
+        title=None,
+        genres=genres,
+        actors=actors,
+        era=era,
+        keywords=[' '.join(keywords)] if keywords else [],
+        source='local'
     )
-        # response_format=MovieTags,
-    result = completion.choices[0].message.content
-    return result
+
+def extract_preferences(input_sentence: str) -> UserPreferences:
+    """LLM tag extraction, or the local keyword parse if the LLM is unavailable."""
+    try:
+        return UPSTREAMS['openai'].call(extract_tags_from_input, input_sentence)
+    except UpstreamError as e:
+        logger.warning(f"Tag extraction unavailable, parsing locally: {e}")
+        return parse_preferences_locally(input_sentence)
+
+def search_with_fallback(keywords, filter):
+    """Marqo search, or cached results, or a local scan if Marqo is unavailable."""
+    marqo = UPSTREAMS['marqo']
+    try:
+        if SEARCH_HEDGE_AFTER is not None:
+            return marqo.hedged_call(search_movies, keywords, filter, hedge_after=SEARCH_HEDGE_AFTER)
+        return marqo.call(search_movies, keywords, filter)
+    except UpstreamError as e:
+        logger.warning(f"Search unavailable, using local results: {e}")
+        cached = cached_search(keywords, filter)
+        if cached is not None:
+            return cached
+        return local_search(keywords, filter)
+
+def canonicalize_preferences(preferences: UserPreferences, entity_index) -> UserPreferences:
+    """Map the title and actor names from the LLM to their spelling in the catalog.
+
+    Names are only rewritten when EntityIndex.resolve is confident, and are
+    matched to an actor before a director of the same name. Names that match a
+    director are moved to the keywords, since directors are searched lexically
+    rather than filtered on. Names without a confident match are kept as they are.
+    """
+    title = preferences.title
+    if title:
+        match = entity_index.resolve(title, TITLE)
+        if match:
+            title = match.name
+
+    actors = []
+    keywords = list(preferences.keywords or [])
+    for name, wanted in preferences.actors or []:
+        match = entity_index.resolve(name, (ACTOR, DIRECTOR))
+        if match is None:
+            actors.append((name, wanted))
+        elif match.kind == ACTOR:
+            actors.append((match.name, wanted))
+        elif wanted == 1:
+            keywords.append(match.name)
+
+    return replace(preferences, title=title, actors=actors, keywords=keywords)
 
 def construct_user_query(preferences: UserPreferences) -> tuple[str, str]:
         positive_terms = []
@@ -148,11 +369,37 @@ def print_results(top_hits):
     except Exception as e:
         logger.error(f"Error printing results: {e}")
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return number
+
 def main():
+    parser = argparse.ArgumentParser(description='Natural language movie recommendations.')
+    parser.add_argument('--batch', metavar='FILE', help='recommend for every line of FILE instead of one request')
+    parser.add_argument('--output', metavar='FILE', default='recommendations.jsonl', help='JSONL output of --batch')
+    parser.add_argument('--concurrency', type=positive_int, default=BATCH_CONCURRENCY, help='parallel tag extractions in --batch')
+    parser.add_argument('--profile', action='store_true', help='write a profile of the run to the profiles directory')
+    args = parser.parse_args()
+    profiling = profiling_requested(flag=args.profile)
+
     try:
+        if args.batch:
+            # Imported here, as batch imports this module
+            from batch import run_batch_file
+            with profile_request('batch', profiling):
+                summary = run_batch_file(args.batch, args.output, args.concurrency)
+            print(f"{summary['queries']} queries ({summary['unique_queries']} unique, {summary['errors']} errors, "
+                  f"{summary['degraded']} degraded) "
+                  f"in {summary['seconds']:.1f}s: {summary['queries_per_sec']:.2f} queries/sec, "
+                  f"{summary['bulk_search_calls']} bulk search calls. Results written to {args.output}")
+            return
+
         # Change the index for different user requests.
         input_sentence = USER_REQUESTS[1]        
-        top_hits = find_recommendations(input_sentence)
+        with profile_request('find_recommendations', profiling):
+            top_hits = find_recommendations(input_sentence)
         print_results(top_hits)
         
     except Exception as e:
@@ -161,23 +408,51 @@ def main():
 
 def find_recommendations(input_sentence: str) -> List[str]:
     try:
-        # Extract tags using OpenAI API
-        output = extract_tags_from_input(input_sentence)
-        logger.info(output) # Output from OpenAI
-        print(output)
-        preferences = UserPreferences.from_json(json.loads(output))
-
-        keywords, filter = construct_user_query(preferences)
+        with request_budget():
+            # Extract tags using OpenAI API
+            preferences = extraction_flight.do(normalize_input(input_sentence), extract_preferences, input_sentence)
+            keywords, filter = build_search(preferences)
 
-        # Search with debug info
-        results = search_movies(keywords,filter)
-        top_hits = get_top_results(results)
-        print_results(top_hits)
-        return top_hits
+            # Search with debug info
+            results = search_flight.do((keywords, filter), search_with_fallback, keywords, filter)
+            return rank_results(results)
         
     except Exception as e:
         logger.error(f"Error occurred: {e}")
         raise
 
+async def find_recommendations_async(input_sentence: str) -> List[str]:
+    """find_recommendations for asyncio callers; coalesces with threaded callers too."""
+    try:
+        with request_budget():
+            preferences = await extraction_flight.do_async(
+                normalize_input(input_sentence), asyncio.to_thread, extract_preferences, input_sentence)
+            keywords, filter = build_search(preferences)
+
+            results = await search_flight.do_async(
+                (keywords, filter), asyncio.to_thread, search_with_fallback, keywords, filter)
+            return rank_results(results)
+
+    except Exception as e:
+        logger.error(f"Error occurred: {e}")
+        raise
+
+def build_search(preferences):
+    logger.info(preferences) # Output from OpenAI
+    print(preferences)
+    preferences = canonicalize_preferences(preferences, get_entity_index())
+    return construct_user_query(preferences)
+
+def rank_results(results):
+    top_hits = get_top_results(results)
+    print_results(top_hits)
+    # Search results are shared between coalesced callers, who add their own
+    # links and details to the hits, so each caller gets its own copies.
+    return [dict(hit) for hit in top_hits]
+
+def coalescing_stats():
+    """Calls and deduplicated calls of the coalesced upstreams."""
+    return [extraction_flight.stats(), search_flight.stats()]
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,5 @@
 from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, Float, String, DateTime, Table, ForeignKey, Text
+from sqlalchemy import Column, Integer, Float, String, DateTime, Table, ForeignKey, Text, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
@@ -7,7 +7,7 @@ Base = declarative_base()
 
 # Association table for movie-genre many-to-many relationship
 movie_genre = Table('movie_genre', Base.metadata,
-    Column('movie_id', Integer, ForeignKey('movies.id')),
+    Column('movie_id', Integer, ForeignKey('movies.id'), index=True),
     Column('genre_id', Integer, ForeignKey('genres.id'))
 )
 
@@ -34,14 +34,14 @@ class Keyword(Base):
     __tablename__ = 'keywords'
     
     keyword_id = Column(Integer, primary_key=True)
-    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False)
+    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False, index=True)
     keywords = Column(Text, nullable=False)
 class Actor(Base):
     __tablename__ = 'actors'
     
     actor_id = Column(Integer, primary_key=True)
     actor_name = Column(String, nullable=False)
-    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False)
+    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False, index=True)
 
 class Link(Base):
     __tablename__ = 'links'
@@ -50,3 +50,19 @@ class Link(Base):
     imdb_id = Column(Integer)
     tmdb_id = Column(Integer)
     poster_path = Column(String)
+
+# Denormalised search documents, one row per movie, built from the tables above.
+# Holds the final indexed fields so index builds and local search can read them
+# with a plain scan instead of re-running the genre/keyword/actor joins.
+class MovieDocument(Base):
+    __tablename__ = 'movie_documents'
+
+    movie_id = Column(Integer, ForeignKey('movies.id'), primary_key=True)
+    text = Column(Text, nullable=False)
+    title = Column(String, nullable=False)
+    genres = Column(JSON, nullable=False)
+    actors = Column(JSON, nullable=False)
+    director = Column(String)
+    year = Column(String)
+    popularity = Column(Float)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
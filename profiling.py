@@ -0,0 +1,257 @@
+# Opt-in profiling of single requests.
+#
+# A request is profiled when PROFILE_REQUESTS=1 is set, when main.py runs with
+# --profile, or when an app request carries a valid X-Profile-Token header
+# for its route (see make_profile_token). The request's thread, and worker threads while they
+# run functions wrapped with bind_to_request, are sampled from a background
+# thread; the stacks are written to PROFILES_DIR in collapsed-stack format
+# (for flamegraph.pl or https://www.speedscope.app) together with a summary of
+# the hottest functions. Each stack starts with the name of its thread pool.
+# Only the newest PROFILES_KEEP profiles are kept. Requests that are not
+# profiled only pay for the check.
+#
+# Usage:
+#   PROFILE_SECRET=... python profiling.py token /   # prints a header value for /
+#   curl -H "X-Profile-Token: <token>" -d user_input=... http://localhost:5000/
+from collections import Counter
+from contextlib import contextmanager
+import contextvars
+from datetime import datetime
+import hashlib
+import hmac
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+
+from config import PROFILE_SAMPLE_INTERVAL, PROFILE_TOP_N, PROFILES_DIR, PROFILES_KEEP
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = 'PROFILE_REQUESTS'
+PROFILE_HEADER = 'X-Profile-Token'
+PROFILE_SECRET_ENV = 'PROFILE_SECRET'
+# Seconds a profile token stays valid
+PROFILE_TOKEN_MAX_AGE = 300
+# Seconds a token's time may be ahead of the server's clock
+PROFILE_TOKEN_CLOCK_SKEW = 5
+
+_active_profiler = contextvars.ContextVar('active_profiler', default=None)
+_THREAD_NUMBER = re.compile(r'_\d+$')
+_NONCE = re.compile(r'[0-9a-f]{32}')
+# Nonces of accepted tokens, with the time they expire. Kept per process.
+_used_nonces = {}
+_used_nonces_lock = threading.Lock()
+
+
+def make_profile_token(route, secret=None, timestamp=None, nonce=None):
+    """Return a header value "<unix time>:<nonce>:<signature>" for one request to route.
+
+    The signature is an HMAC-SHA256 of the time, the nonce and the route.
+    """
+    secret = secret or os.environ[PROFILE_SECRET_ENV]
+    timestamp = str(int(timestamp if timestamp is not None else time.time()))
+    nonce = nonce or secrets.token_hex(16)
+    message = f"{timestamp}:{nonce}:{route}"
+    signature = hmac.new(secret.encode('utf-8'), message.encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"{timestamp}:{nonce}:{signature}"
+
+def _use_nonce(nonce, expires):
+    """Record nonce as used; False if it already was."""
+    now = time.time()
+    with _used_nonces_lock:
+        for used in [used for used, used_expires in _used_nonces.items() if used_expires < now]:
+            del _used_nonces[used]
+        if nonce in _used_nonces:
+            return False
+        _used_nonces[nonce] = expires
+        return True
+
+def valid_profile_token(token, route, secret=None):
+    """True if token was made for route with the profile secret in the last
+    PROFILE_TOKEN_MAX_AGE seconds and has not been used before."""
+    secret = secret or os.getenv(PROFILE_SECRET_ENV)
+    if not token or not secret:
+        return False
+    timestamp, nonce, _ = (token.split(':') + ['', ''])[:3]
+    if not timestamp.isdigit() or not _NONCE.fullmatch(nonce):
+        return False
+    age = time.time() - int(timestamp)
+    if age > PROFILE_TOKEN_MAX_AGE or age < -PROFILE_TOKEN_CLOCK_SKEW:
+        return False
+    if not hmac.compare_digest(make_profile_token(route, secret, int(timestamp), nonce), token):
+        return False
+    return _use_nonce(nonce, int(timestamp) + PROFILE_TOKEN_MAX_AGE)
+
+def profiling_requested(headers=None, route=None, flag=False):
+    """True if this request should be profiled: CLI flag, environment or a header signed for route."""
+    if flag or os.getenv(PROFILE_ENV) == '1':
+        return True
+    return (headers is not None and route is not None and PROFILE_HEADER in headers
+            and valid_profile_token(headers[PROFILE_HEADER], route))
+
+def bind_to_request(fn):
+    """Return fn wrapped so the thread running it is sampled by the current
+    request's profile, or fn itself if the request is not profiled.
+
+    Call this in the request's thread, when handing work to a thread pool.
+    """
+    profiler = _active_profiler.get()
+    if profiler is None:
+        return fn
+
+    def run(*args, **kwargs):
+        # Work this thread hands on to another pool (e.g. an upstream call
+        # from a batch worker) is bound to the same profile
+        token = _active_profiler.set(profiler)
+        profiler.add_thread()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.remove_thread()
+            _active_profiler.reset(token)
+    return run
+
+_BOUND_CODE = next(const for const in bind_to_request.__code__.co_consts if getattr(const, 'co_name', None) == 'run')
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """Samples the call stacks of a request's threads at a fixed interval.
+
+    The request thread is always sampled; worker threads only between
+    add_thread and remove_thread.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.ticks = 0
+        self.elapsed = 0.0
+        self._workers = Counter()
+        self._workers_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def add_thread(self):
+        with self._workers_lock:
+            self._workers[threading.get_ident()] += 1
+
+    def remove_thread(self):
+        thread_id = threading.get_ident()
+        with self._workers_lock:
+            self._workers[thread_id] -= 1
+            if self._workers[thread_id] <= 0:
+                del self._workers[thread_id]
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._workers_lock:
+                thread_ids = [self.thread_id] + [thread_id for thread_id in self._workers if thread_id != self.thread_id]
+            frames = sys._current_frames()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            self.ticks += 1
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                # Worker stacks stop at the bind_to_request wrapper, leaving
+                # out the thread pool's own frames
+                while frame is not None and (thread_id == self.thread_id or frame.f_code is not _BOUND_CODE):
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    root = 'request' if thread_id == self.thread_id else _THREAD_NUMBER.sub('', names.get(thread_id, 'worker'))
+                    stack.append(f"[{root}]")
+                    self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+        self.elapsed = time.perf_counter() - self._start
+
+    def collapsed(self):
+        """Stacks in collapsed format: "root;caller;callee count" per line."""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def summary(self, top_n=PROFILE_TOP_N):
+        """Text table of the functions with the most self and total samples.
+
+        Times are summed over threads, so with several threads sampled they
+        can add up to more than the wall time.
+        """
+        total_samples = sum(self.samples.values())
+        if not total_samples:
+            return f"No samples in {self.elapsed * 1000:.1f} ms\n"
+        ms_per_sample = self.elapsed * 1000 / self.ticks
+        self_samples, total = Counter(), Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(';')
+            self_samples[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+
+        lines = [f"{total_samples} samples of {len({stack.split(';')[0] for stack in self.samples})} "
+                 f"thread groups over {self.elapsed * 1000:.1f} ms", ""]
+        for title, counts in (("Self time", self_samples), ("Total time", total)):
+            lines.append(f"{title}:")
+            for frame, count in counts.most_common(top_n):
+                lines.append(f"  {count * ms_per_sample:>9.1f} ms {100 * count / self.ticks:>5.1f}%  {frame}")
+            lines.append("")
+        return '\n'.join(lines)
+
+def prune_profiles(keep=PROFILES_KEEP):
+    """Delete all but the newest keep profiles in PROFILES_DIR."""
+    names = sorted({os.path.splitext(entry)[0] for entry in os.listdir(PROFILES_DIR)
+                    if entry.endswith(('.collapsed', '.txt'))})
+    for name in names[:max(len(names) - keep, 0)]:
+        for extension in ('.collapsed', '.txt'):
+            try:
+                os.remove(os.path.join(PROFILES_DIR, name + extension))
+            except FileNotFoundError:
+                # Pruned by a concurrent request
+                pass
+
+@contextmanager
+def profile_request(name, enabled):
+    """Profile the block if enabled; otherwise do nothing.
+
+    Writes <PROFILES_DIR>/<time>-<name>.collapsed and .txt, then prunes the
+    oldest profiles beyond PROFILES_KEEP.
+    """
+    if not enabled:
+        yield
+        return
+
+    profiler = SamplingProfiler(threading.get_ident())
+    token = _active_profiler.set(profiler)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        _active_profiler.reset(token)
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        safe_name = re.sub(r'[^\w-]+', '_', name)
+        path = os.path.join(PROFILES_DIR, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{safe_name}")
+        with open(f"{path}.collapsed", 'w', encoding='utf-8') as f:
+            f.write(profiler.collapsed())
+        with open(f"{path}.txt", 'w', encoding='utf-8') as f:
+            f.write(profiler.summary())
+        logger.info(f"Profile of {name} written to {path}.collapsed and {path}.txt")
+        prune_profiles()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'token':
+        print(make_profile_token(sys.argv[2]))
+    else:
+        print("Usage: PROFILE_SECRET=... python profiling.py token <route, e.g. / or /api/recommend/batch>")
@@ -0,0 +1,310 @@
+# Timeouts, circuit breakers and hedged calls for the upstream services
+# (OpenAI, Marqo and TMDB).
+#
+# Every upstream call runs on that upstream's own bounded worker pool (a
+# bulkhead) and is abandoned once its deadline passes: the smaller of the
+# upstream's own timeout and what is left of the request budget. The clients
+# also have HTTP timeouts, so abandoned calls free their thread soon after. A
+# stalled upstream therefore fills only its own pool, and further calls to it
+# are rejected at once. After repeated failures an upstream's breaker opens and
+# calls fail immediately until a trial call succeeds. Calls cut short by the
+# request budget rather than the upstream's own timeout do not count as
+# failures, and neither do caller errors (4xx responses other than 408 and
+# 429, invalid input), which are not retried by hedging either. Callers catch
+# UpstreamError and fall back to local data.
+#
+# Faults can be injected per upstream, from code or with the UPSTREAM_FAULTS
+# environment variable, e.g. UPSTREAM_FAULTS="marqo:delay=5,openai:error".
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+import contextvars
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from pydantic import ValidationError
+
+from config import REQUEST_BUDGET, UPSTREAM_CONCURRENCY, UPSTREAM_TIMEOUTS
+from profiling import bind_to_request
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+
+
+class UpstreamError(Exception):
+    """An upstream call failed fast, timed out or raised."""
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+class UpstreamTimeout(UpstreamError):
+    pass
+
+class BulkheadFullError(UpstreamError):
+    pass
+
+class InjectedFault(UpstreamError):
+    pass
+
+class CallerError(UpstreamError):
+    """The upstream rejected the request itself; it says nothing about the upstream's health."""
+
+# Client errors that do mean the upstream is struggling
+_RETRYABLE_STATUS = {408, 429}
+
+def is_caller_error(exc: BaseException) -> bool:
+    """True for a 4xx response (other than 408 and 429) or a validation error.
+
+    Reads status_code from the exception (Marqo, OpenAI) or its response
+    (requests). Errors without a status code count as upstream failures.
+    """
+    if isinstance(exc, ValidationError):
+        return True
+    status = getattr(exc, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in _RETRYABLE_STATUS
+
+@contextmanager
+def request_budget(seconds: float = REQUEST_BUDGET):
+    """Limit the total time upstream calls may take within the block.
+
+    Nested budgets never extend an outer one.
+    """
+    deadline = time.monotonic() + seconds
+    if _deadline.get() is not None:
+        deadline = min(deadline, _deadline.get())
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining_budget() -> Optional[float]:
+    """Seconds left in the current request budget, or None outside of one."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures.
+
+    While open, calls are refused. After reset_timeout seconds a single trial
+    call is let through (half open); its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._rejected = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self._rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"Circuit {self.name} closed")
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.warning(f"Circuit {self.name} opened after {self._failures} failures")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def record_ignored(self):
+        """Record a call whose outcome says nothing about the upstream's health."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'name': self.name,
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'rejected_calls': self._rejected,
+            }
+
+class Upstream:
+    """An upstream service with a per-call timeout, a circuit breaker and its own worker pool."""
+
+    def __init__(self, name: str, timeout: float, max_concurrency: int = 16,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f'upstream-{name}')
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._bulkhead_rejections = 0
+        self._fault_delay = 0.0
+        self._fault_error = False
+
+    def inject_fault(self, delay: float = 0.0, error: bool = False):
+        """Delay every call by delay seconds and/or make it raise, for testing fallbacks."""
+        self._fault_delay = delay
+        self._fault_error = error
+
+    def clear_faults(self):
+        self.inject_fault()
+
+    def _deadline_timeout(self, timeout=None):
+        """Return (seconds, whether the request budget rather than the upstream's timeout is the limit)."""
+        timeout = self.timeout if timeout is None else timeout
+        remaining = remaining_budget()
+        budget_limited = remaining is not None and remaining < timeout
+        if budget_limited:
+            timeout = remaining
+        if timeout <= 0:
+            raise UpstreamTimeout(f"No request budget left for {self.name}")
+        return timeout, budget_limited
+
+    def _reserve(self):
+        """Take a worker slot and pass the breaker, or raise."""
+        if not self._slots.acquire(blocking=False):
+            self._bulkhead_rejections += 1
+            raise BulkheadFullError(f"All {self.max_concurrency} workers for {self.name} are busy")
+        if not self.breaker.allow():
+            self._slots.release()
+            raise CircuitOpenError(f"Circuit for {self.name} is open")
+
+    def _submit(self, fn, args, kwargs):
+        """Run fn on the pool. The caller must hold a slot; it is released when fn returns."""
+        delay, error = self._fault_delay, self._fault_error
+
+        def run():
+            try:
+                if delay:
+                    time.sleep(delay)
+                if error:
+                    raise InjectedFault(f"Injected fault in {self.name}")
+                return fn(*args, **kwargs)
+            finally:
+                self._slots.release()
+        return self._executor.submit(bind_to_request(run))
+
+    def _record_timeout(self, budget_limited):
+        if budget_limited:
+            self.breaker.record_ignored()
+        else:
+            self.breaker.record_failure()
+
+    def _failed(self, error):
+        """Record a call that raised error and return the UpstreamError to raise."""
+        if is_caller_error(error):
+            self.breaker.record_ignored()
+            return CallerError(f"{self.name} rejected the request: {error}")
+        self.breaker.record_failure()
+        return UpstreamError(f"{self.name} failed: {error}")
+
+    def call(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Return fn(*args, **kwargs) within the deadline, or raise UpstreamError.
+
+        timeout replaces the upstream's own timeout for this call, e.g. for
+        requests whose size varies.
+        """
+        timeout, budget_limited = self._deadline_timeout(timeout)
+        self._reserve()
+        future = self._submit(fn, args, kwargs)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._record_timeout(budget_limited)
+            raise UpstreamTimeout(f"{self.name} did not answer within {timeout:.2f}s")
+        except Exception as e:
+            raise self._failed(e) from e
+        self.breaker.record_success()
+        return result
+
+    def hedged_call(self, fn: Callable, *args, hedge_after: float, **kwargs) -> Any:
+        """Like call, but starts a second attempt if the first has not succeeded
+        after hedge_after seconds, and returns whichever succeeds first.
+        The second attempt is skipped if the pool has no free worker or the
+        first was rejected as a caller error, which would only repeat."""
+        timeout, budget_limited = self._deadline_timeout()
+        self._reserve()
+        deadline = time.monotonic() + timeout
+        first = self._submit(fn, args, kwargs)
+        wait([first], timeout=min(hedge_after, timeout))
+        pending = {first}
+        hedge = not first.done() or (first.exception() is not None and not is_caller_error(first.exception()))
+        if hedge and self._slots.acquire(blocking=False):
+            pending.add(self._submit(fn, args, kwargs))
+
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.breaker.record_success()
+                    return future.result()
+                error = future.exception()
+                if is_caller_error(error):
+                    # The other attempt would be rejected the same way
+                    raise self._failed(error) from error
+
+        if pending or error is None:
+            self._record_timeout(budget_limited)
+            raise UpstreamTimeout(f"{self.name} did not answer within {timeout:.2f}s")
+        raise self._failed(error) from error
+
+    def state(self) -> Dict[str, Any]:
+        return {**self.breaker.snapshot(), 'bulkhead_rejections': self._bulkhead_rejections}
+
+UPSTREAMS = {
+    name: Upstream(name, timeout, UPSTREAM_CONCURRENCY[name])
+    for name, timeout in UPSTREAM_TIMEOUTS.items()
+}
+
+def upstream_states():
+    """Breaker and bulkhead state of every upstream, for health checks and logs."""
+    return [upstream.state() for upstream in UPSTREAMS.values()]
+
+def inject_faults_from_env(spec: Optional[str] = None):
+    """Apply faults from a spec like "marqo:delay=5,openai:error"."""
+    spec = os.getenv('UPSTREAM_FAULTS', '') if spec is None else spec
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, fault = item.partition(':')
+        if name not in UPSTREAMS:
+            logger.warning(f"Unknown upstream in UPSTREAM_FAULTS: {name}")
+            continue
+        if fault.startswith('delay='):
+            UPSTREAMS[name].inject_fault(delay=float(fault[len('delay='):]))
+        else:
+            UPSTREAMS[name].inject_fault(error=True)
+
+inject_faults_from_env()
@@ -0,0 +1,127 @@
+# Single-flight request coalescing.
+# Concurrent callers asking for the same key share one in-flight computation
+# instead of each calling the upstream. Nothing is cached: once a computation
+# finishes, the next caller for that key starts a new one.
+import asyncio
+from concurrent.futures import Future, InvalidStateError
+import re
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_input(sentence: str) -> str:
+    """Coalescing key for a user sentence: case, spacing and end punctuation ignored."""
+    return _WHITESPACE.sub(' ', sentence.casefold()).strip(' .!?,;')
+
+class _LeaderAbandoned(Exception):
+    """Put on the shared future when the leader stopped without a result."""
+
+class SingleFlight:
+    """Deduplicates concurrent calls with the same key, across threads and asyncio tasks.
+
+    The first caller for a key (the leader) runs the computation; callers that
+    arrive while it is in flight wait for the leader's result or exception.
+    Thread callers use do(), asyncio tasks use do_async(); both can wait on a
+    computation started by the other. Only exceptions are shared: if the
+    leader is cancelled or interrupted, one of the waiting callers becomes the
+    new leader and runs the computation again.
+
+    Example:
+        >>> searches = SingleFlight('search')
+        >>> results = searches.do((query, filter), search_movies, query, filter)
+        >>> searches.stats()
+        {'name': 'search', 'calls': 1, 'deduplicated': 0, 'in_flight': 0}
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._calls = 0
+        self._deduplicated = 0
+
+    def _join(self, key, retry=False):
+        """Return (future, is_leader) for key. Retries after an abandoned leader are not counted."""
+        with self._lock:
+            if not retry:
+                self._calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                if not retry:
+                    self._deduplicated += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _finish(self, key, future, result=None, exception=None):
+        with self._lock:
+            del self._in_flight[key]
+        # The shared future is never handed out cancellable, but a waiter that
+        # finished it anyway must not turn the leader's result into an error.
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """Return fn(*args, **kwargs), sharing the call with concurrent callers of key."""
+        retry = False
+        while True:
+            future, is_leader = self._join(key, retry)
+            if is_leader:
+                break
+            try:
+                return future.result()
+            except _LeaderAbandoned:
+                retry = True
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            raise
+        except BaseException:
+            self._finish(key, future, exception=_LeaderAbandoned())
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    async def do_async(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """Return await fn(*args, **kwargs), sharing the call with concurrent callers of key."""
+        retry = False
+        while True:
+            future, is_leader = self._join(key, retry)
+            if is_leader:
+                break
+            try:
+                # Each follower awaits its own shielded wrapper, so cancelling
+                # one follower (a timeout, a client disconnect) cannot cancel
+                # the shared future under the leader and the other followers.
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _LeaderAbandoned:
+                retry = True
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            raise
+        except BaseException:
+            # Cancelled: a follower takes over rather than seeing CancelledError
+            self._finish(key, future, exception=_LeaderAbandoned())
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'name': self.name,
+                'calls': self._calls,
+                'deduplicated': self._deduplicated,
+                'in_flight': len(self._in_flight),
+            }
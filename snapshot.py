@@ -0,0 +1,318 @@
+# Columnar, memory-mapped snapshot of the movie catalog.
+#
+# The snapshot is written after load_data and after every document refresh, and
+# opened read-only by every worker. Numeric columns are fixed-width arrays, string columns are an offsets
+# array into a UTF-8 blob, and genres/actors are CSR-style lists of ids into
+# a name dictionary. All sections live in one file, so workers share the pages
+# through the OS page cache instead of each holding its own copy of the catalog.
+#
+# File layout:
+#   MAGIC | uint32 toc length | JSON table of contents | padding | sections...
+# Every section starts on an 8 byte boundary.
+from array import array
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+
+from config import SNAPSHOT_LOCATION
+from models import Link, Movie, MovieDocument
+
+MAGIC = b'MOVSNAP1'
+VERSION = 1
+MISSING_ID = -1
+
+NUMERIC_COLUMNS = {
+    'id': 'q',
+    'year': 'i',
+    'popularity': 'd',
+    'imdb_id': 'q',
+    'tmdb_id': 'q',
+}
+STRING_COLUMNS = ['title', 'director', 'overview', 'poster_path']
+LIST_COLUMNS = ['genres', 'actors']
+
+
+def _pad(length):
+    return (8 - length % 8) % 8
+
+class _StringColumnBuilder:
+    def __init__(self):
+        self.offsets = array('Q', [0])
+        self.data = bytearray()
+
+    def append(self, value):
+        if value:
+            self.data += str(value).encode('utf-8')
+        self.offsets.append(len(self.data))
+
+class _ListColumnBuilder:
+    def __init__(self):
+        self.names = {}
+        self.indptr = array('Q', [0])
+        self.indices = array('I')
+
+    def append(self, values):
+        for value in values or []:
+            self.indices.append(self.names.setdefault(value, len(self.names)))
+        self.indptr.append(len(self.indices))
+
+    def name_column(self):
+        column = _StringColumnBuilder()
+        for name in self.names:
+            column.append(name)
+        return column
+
+def write_snapshot(session, path=SNAPSHOT_LOCATION):
+    """Write a columnar snapshot of the catalog currently in the database.
+
+    Reads movies, links and the genre/actor arrays of the movie_documents table
+    in one ordered scan. The file is written to a temporary file next to its
+    destination, synced and renamed into place, so readers never observe a
+    partially written snapshot. The whole catalog is rewritten every time.
+
+    Args:
+        session (Session): SQLAlchemy session object
+        path (str): Destination of the snapshot file
+
+    Returns:
+        int: Number of movies written
+    """
+    numeric = {name: array(typecode) for name, typecode in NUMERIC_COLUMNS.items()}
+    strings = {name: _StringColumnBuilder() for name in STRING_COLUMNS}
+    lists = {name: _ListColumnBuilder() for name in LIST_COLUMNS}
+
+    query = (
+        select(
+            Movie.id,
+            Movie.title,
+            Movie.year,
+            Movie.director,
+            Movie.overview,
+            Movie.popularity,
+            Link.imdb_id,
+            Link.tmdb_id,
+            Link.poster_path,
+            MovieDocument.genres,
+            MovieDocument.actors
+        )
+        .join(Link, Link.movie_id == Movie.id, isouter=True)
+        .join(MovieDocument, MovieDocument.movie_id == Movie.id, isouter=True)
+        .order_by(Movie.id)
+        .execution_options(yield_per=1000)
+    )
+    for row in session.execute(query):
+        numeric['id'].append(row.id)
+        numeric['year'].append(row.year or 0)
+        numeric['popularity'].append(row.popularity or 0.0)
+        numeric['imdb_id'].append(int(row.imdb_id) if row.imdb_id is not None else MISSING_ID)
+        numeric['tmdb_id'].append(int(row.tmdb_id) if row.tmdb_id is not None else MISSING_ID)
+        for name in STRING_COLUMNS:
+            strings[name].append(getattr(row, name))
+        for name in LIST_COLUMNS:
+            lists[name].append(getattr(row, name))
+
+    imdb_ids = numeric['imdb_id']
+    imdb_order = array('I', sorted(range(len(imdb_ids)), key=imdb_ids.__getitem__))
+
+    sections = [(name, column) for name, column in numeric.items()]
+    sections.append(('imdb_order', imdb_order))
+    for name, column in strings.items():
+        sections += [(f'{name}.offsets', column.offsets), (f'{name}.data', column.data)]
+    for name, column in lists.items():
+        names = column.name_column()
+        sections += [
+            (f'{name}.indptr', column.indptr),
+            (f'{name}.indices', column.indices),
+            (f'{name}.names.offsets', names.offsets),
+            (f'{name}.names.data', names.data),
+        ]
+
+    # Offsets are relative to the end of the header, so the table of contents
+    # does not depend on its own length.
+    toc = {'version': VERSION, 'byteorder': sys.byteorder, 'rows': len(numeric['id']), 'sections': {}}
+    position = 0
+    for name, column in sections:
+        typecode = column.typecode if isinstance(column, array) else 'B'
+        nbytes = len(column) * (column.itemsize if isinstance(column, array) else 1)
+        toc['sections'][name] = [position, nbytes, typecode]
+        position += nbytes + _pad(nbytes)
+    toc_bytes = json.dumps(toc).encode('utf-8')
+    header_length = len(MAGIC) + 4 + len(toc_bytes)
+
+    # A temporary file of its own per writer, so concurrent refreshes never
+    # write into the same file, synced before it replaces the snapshot
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(toc_bytes)))
+            f.write(toc_bytes)
+            f.write(b'\0' * _pad(header_length))
+            for _, column in sections:
+                data = column.tobytes() if isinstance(column, array) else bytes(column)
+                f.write(data)
+                f.write(b'\0' * _pad(len(data)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return toc['rows']
+
+class CatalogSnapshot:
+    """Read-only, memory-mapped view of a catalog snapshot.
+
+    Rows are ordered by movie id. Lookups by row only slice the mapped file;
+    no per-movie Python objects are kept.
+
+    Example:
+        >>> snapshot = CatalogSnapshot('movies.snapshot')
+        >>> row = snapshot.row_of(1)
+        >>> snapshot.title(row), snapshot.genres(row)
+        ('Toy Story', ['Adventure', 'Animation', 'Children', 'Comedy', 'Fantasy'])
+    """
+
+    def __init__(self, path=SNAPSHOT_LOCATION):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        (toc_length,) = struct.unpack_from('<I', buffer, len(MAGIC))
+        toc_start = len(MAGIC) + 4
+        toc = json.loads(bytes(buffer[toc_start:toc_start + toc_length]))
+        if toc['version'] != VERSION or toc['byteorder'] != sys.byteorder:
+            raise ValueError(f"Unsupported snapshot {path}: version {toc['version']}, {toc['byteorder']} endian")
+
+        data_start = toc_start + toc_length + _pad(toc_start + toc_length)
+        self._views = {}
+        for name, (offset, nbytes, typecode) in toc['sections'].items():
+            view = buffer[data_start + offset:data_start + offset + nbytes]
+            self._views[name] = view.cast(typecode) if typecode != 'B' else view
+        self._buffer = buffer
+        self.rows = toc['rows']
+
+        self.ids = self._views['id']
+        self.years = self._views['year']
+        self.popularities = self._views['popularity']
+        self.imdb_ids = self._views['imdb_id']
+        self.tmdb_ids = self._views['tmdb_id']
+        self._imdb_order = self._views['imdb_order']
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        for view in self._views.values():
+            view.release()
+        self._buffer.release()
+        self._mmap.close()
+
+    def row_of(self, movie_id: int) -> Optional[int]:
+        """Return the row of a movie id, or None if it is not in the snapshot."""
+        row = bisect.bisect_left(self.ids, movie_id)
+        if row < self.rows and self.ids[row] == movie_id:
+            return row
+        return None
+
+    def row_of_imdb_id(self, imdb_id: int) -> Optional[int]:
+        """Return the row of an IMDb id (without the 'tt' prefix), or None."""
+        low, high = 0, self.rows
+        while low < high:
+            middle = (low + high) // 2
+            if self.imdb_ids[self._imdb_order[middle]] < imdb_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.rows and self.imdb_ids[self._imdb_order[low]] == imdb_id:
+            return self._imdb_order[low]
+        return None
+
+    def _string(self, name, row):
+        offsets = self._views[f'{name}.offsets']
+        start, end = offsets[row], offsets[row + 1]
+        if start == end:
+            return None
+        return str(self._views[f'{name}.data'][start:end], 'utf-8')
+
+    def _list(self, name, row):
+        indptr = self._views[f'{name}.indptr']
+        indices = self._views[f'{name}.indices']
+        return [self._string(f'{name}.names', index) for index in indices[indptr[row]:indptr[row + 1]]]
+
+    def title(self, row) -> str:
+        return self._string('title', row)
+
+    def director(self, row) -> Optional[str]:
+        return self._string('director', row)
+
+    def overview(self, row) -> Optional[str]:
+        return self._string('overview', row)
+
+    def poster_path(self, row) -> Optional[str]:
+        return self._string('poster_path', row)
+
+    def genres(self, row) -> List[str]:
+        return self._list('genres', row)
+
+    def actors(self, row) -> List[str]:
+        return self._list('actors', row)
+
+    def imdb_id(self, row) -> Optional[int]:
+        imdb_id = self.imdb_ids[row]
+        return imdb_id if imdb_id != MISSING_ID else None
+
+    def tmdb_id(self, row) -> Optional[int]:
+        tmdb_id = self.tmdb_ids[row]
+        return tmdb_id if tmdb_id != MISSING_ID else None
+
+    def movie(self, row) -> Dict[str, Any]:
+        """Return every column of a row as a dict."""
+        return {
+            'id': self.ids[row],
+            'title': self.title(row),
+            'year': self.years[row] or None,
+            'director': self.director(row),
+            'overview': self.overview(row),
+            'popularity': self.popularities[row],
+            'imdb_id': self.imdb_id(row),
+            'tmdb_id': self.tmdb_id(row),
+            'poster_path': self.poster_path(row),
+            'genres': self.genres(row),
+            'actors': self.actors(row),
+        }
+
+_snapshot = None
+_snapshot_stat = None
+_snapshot_lock = threading.Lock()
+
+def get_snapshot(path=SNAPSHOT_LOCATION) -> Optional[CatalogSnapshot]:
+    """Return the process-wide snapshot, or None if it has not been written yet.
+
+    The file is reopened when it has been replaced, e.g. by
+    database.refresh_movie_documents. The old mapping is not closed, as other
+    threads may still be reading it; it is unmapped once no longer referenced.
+    """
+    global _snapshot, _snapshot_stat
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if key != _snapshot_stat:
+        with _snapshot_lock:
+            if key != _snapshot_stat:
+                _snapshot = CatalogSnapshot(path)
+                _snapshot_stat = key
+    return _snapshot
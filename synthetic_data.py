@@ -0,0 +1,127 @@
+# Synthetic catalog generator.
+# Writes movies.csv, actors.csv, keywords.csv and links.csv in the same schemas as
+# datasets/ml-latest-small, at any scale, so the loaders and index builds can be
+# exercised at production size. Cast sizes, keyword counts, popularity and the
+# choice of directors and actors are skewed the way real catalogs are: most
+# movies are obscure with small casts, a few are very popular, and a small set
+# of people appear in many movies.
+import argparse
+import csv
+import math
+import os
+import random
+import string
+
+from config import GENRE_LIST
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+    'Daniel', 'Nancy', 'Matthew', 'Lisa', 'Anthony', 'Betty', 'Mark', 'Sandra', 'Steven', 'Ashley',
+    'Paul', 'Emily', 'Andrew', 'Donna', 'Kenji', 'Michelle', 'Pedro', 'Carol', 'Ingrid', 'Amanda',
+]
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark', 'Ramirez', 'Lewis', 'Robinson',
+    'Walker', 'Young', 'Allen', 'King', 'Wright', 'Scott', 'Torres', 'Nguyen', 'Hill', 'Flores',
+    'Green', 'Adams', 'Nelson', 'Baker', 'Hall', 'Rivera', 'Campbell', 'Mitchell', 'Carter', 'Roberts',
+]
+TITLE_WORDS = [
+    'Silent', 'River', 'Night', 'Last', 'Empire', 'Dream', 'Shadow', 'City', 'Return', 'Secret',
+    'Summer', 'Heart', 'Storm', 'Blood', 'Star', 'Island', 'Road', 'Winter', 'Ghost', 'King',
+    'Love', 'War', 'Machine', 'Garden', 'Fire', 'Ocean', 'Stranger', 'House', 'Mountain', 'Story',
+]
+VOCABULARY = [
+    'rescue', 'friendship', 'mission', 'jealousy', 'villain', 'revenge', 'prison', 'escape', 'heist', 'family',
+    'murder', 'detective', 'space', 'alien', 'robot', 'future', 'dystopia', 'holocaust', 'war', 'soldier',
+    'love', 'wedding', 'christmas', 'mother', 'father', 'addiction', 'drug', 'school', 'music', 'dance',
+    'small town', 'road trip', 'based on novel', 'time travel', 'survival', 'conspiracy', 'betrayal', 'ghost',
+    'haunted house', 'serial killer', 'courtroom', 'sports', 'coming of age', 'loneliness', 'kingdom', 'battle',
+]
+
+
+def person_name(index):
+    """Deterministic, unique person name for a pool index."""
+    first = FIRST_NAMES[index % len(FIRST_NAMES)]
+    last = LAST_NAMES[(index // len(FIRST_NAMES)) % len(LAST_NAMES)]
+    generation = index // (len(FIRST_NAMES) * len(LAST_NAMES))
+    return f"{first} {last}" if generation == 0 else f"{first} {last} {generation + 1}"
+
+def skewed_index(rng, size, skew):
+    """Pick from range(size) so that low indices are chosen far more often."""
+    return int(size * rng.random() ** skew)
+
+def skewed_count(rng, alpha, scale, maximum):
+    """Heavy tailed count: most values are small, a few are large."""
+    return min(maximum, int(scale * (rng.paretovariate(alpha) - 1)))
+
+def generate_catalog(out_dir, num_movies, seed=42):
+    """Write a synthetic catalog of num_movies movies to out_dir.
+
+    Args:
+        out_dir (str): Directory to write the CSV files to. Created if missing.
+        num_movies (int): Number of movies to generate, e.g. 10_000 to 10_000_000.
+        seed (int): Random seed. The same seed and scale give identical files.
+
+    Returns:
+        Dict[str, str]: Paths of the written files keyed like config.CSV_FILES
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {name: os.path.join(out_dir, f'{name}.csv') for name in ('movies', 'actors', 'keywords', 'links')}
+
+    num_directors = max(1, num_movies // 8)
+    num_actors = max(1, num_movies * 2)
+
+    with open(paths['movies'], 'w', newline='', encoding='utf-8') as movies_file, \
+         open(paths['actors'], 'w', newline='', encoding='utf-8') as actors_file, \
+         open(paths['keywords'], 'w', newline='', encoding='utf-8') as keywords_file, \
+         open(paths['links'], 'w', newline='', encoding='utf-8') as links_file:
+        movies = csv.writer(movies_file)
+        actors = csv.writer(actors_file)
+        keywords = csv.writer(keywords_file)
+        links = csv.writer(links_file)
+        movies.writerow(['movieId', 'title', 'year', 'director', 'popularity', 'genres', 'overview'])
+        actors.writerow(['movie_id', 'actor_name'])
+        keywords.writerow(['movie_id', 'keywords'])
+        links.writerow(['movieId', 'imdbId', 'tmdbId', 'poster_path'])
+
+        for movie_id in range(1, num_movies + 1):
+            title = ' '.join(rng.choice(TITLE_WORDS) for _ in range(rng.randint(1, 4)))
+            year = rng.randint(1920, 2024) if rng.random() > 0.01 else ''
+            director = person_name(skewed_index(rng, num_directors, 2.0)) if rng.random() > 0.03 else ''
+            popularity = round(math.exp(rng.gauss(1.5, 1.3)), 3)
+            if rng.random() < 0.005:
+                genres = '(no genres listed)'
+            else:
+                genres = '|'.join(rng.sample(GENRE_LIST, 1 + skewed_count(rng, 2.5, 1.5, 5)))
+            overview = ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randint(15, 80))).capitalize() + '.'
+            if rng.random() < 0.02:
+                overview = ''
+            movies.writerow([movie_id, f"{title} {movie_id}", year, director, popularity, genres, overview])
+
+            cast_size = skewed_count(rng, 1.6, 4, 60)
+            cast = dict.fromkeys(person_name(skewed_index(rng, num_actors, 3.0)) for _ in range(cast_size))
+            actors.writerows([movie_id, name] for name in cast)
+
+            if rng.random() < 0.92:
+                keyword_count = 1 + skewed_count(rng, 1.4, 5, 120)
+                movie_keywords = dict.fromkeys(rng.choice(VOCABULARY) for _ in range(keyword_count))
+                keywords.writerow([movie_id, ','.join(movie_keywords)])
+
+            poster_path = '/' + ''.join(rng.choices(string.ascii_letters + string.digits, k=27)) + '.jpg'
+            links.writerow([movie_id, 100000 + movie_id, f"{float(200000 + movie_id)}", poster_path])
+
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic movie catalog in the ml-latest-small CSV format.')
+    parser.add_argument('--movies', type=int, default=100_000, help='number of movies to generate (10k to 10M)')
+    parser.add_argument('--out', default=None, help='output directory (default: datasets/synthetic-<movies>)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    out_dir = args.out or f'datasets/synthetic-{args.movies}'
+    for name, path in generate_catalog(out_dir, args.movies, args.seed).items():
+        print(f"{name}: {path}")
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import profiling
+from profiling import bind_to_request, make_profile_token, profile_request, profiling_requested, valid_profile_token
+
+SECRET = 'test-secret'
+
+
+def busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+def nested_work():
+    busy(0.1)
+
+def profiled_stacks(tmp_path):
+    (path,) = tmp_path.glob('*.collapsed')
+    return path.read_text(encoding='utf-8').splitlines()
+
+
+def test_unprofiled_functions_are_not_wrapped():
+    assert bind_to_request(nested_work) is nested_work
+
+def test_nested_submissions_are_sampled(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILES_DIR', str(tmp_path))
+    with ThreadPoolExecutor(1, thread_name_prefix='outer') as outer, \
+            ThreadPoolExecutor(1, thread_name_prefix='inner') as inner:
+
+        def outer_work():
+            return inner.submit(bind_to_request(nested_work)).result()
+
+        with profile_request('nested', True):
+            outer.submit(bind_to_request(outer_work)).result()
+
+    stacks = profiled_stacks(tmp_path)
+    assert any(stack.startswith('[inner];') and 'nested_work' in stack for stack in stacks)
+    assert any(stack.startswith('[outer];') for stack in stacks)
+
+def test_threads_stop_being_sampled_after_the_request(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILES_DIR', str(tmp_path))
+    with ThreadPoolExecutor(1, thread_name_prefix='worker') as executor:
+        with profile_request('request', True):
+            executor.submit(bind_to_request(busy), 0.05).result()
+        # The worker's context no longer carries the finished request's profile
+        assert executor.submit(lambda: profiling._active_profiler.get()).result() is None
+
+def test_token_is_valid_once_for_its_route():
+    token = make_profile_token('/', SECRET)
+    assert not valid_profile_token(token, '/api/recommend/batch', SECRET)
+    assert valid_profile_token(token, '/', SECRET)
+    assert not valid_profile_token(token, '/', SECRET)
+
+def test_tokens_from_the_future_or_the_past_are_rejected():
+    now = time.time()
+    assert not valid_profile_token(make_profile_token('/', SECRET, now + 60), '/', SECRET)
+    assert not valid_profile_token(make_profile_token('/', SECRET, now - 301), '/', SECRET)
+    assert valid_profile_token(make_profile_token('/', SECRET, now + 1), '/', SECRET)
+
+def test_forged_tokens_are_rejected():
+    timestamp, nonce, signature = make_profile_token('/', SECRET).split(':')
+    assert not valid_profile_token(make_profile_token('/', 'other-secret'), '/', SECRET)
+    assert not valid_profile_token(f"{timestamp}:{'0' * 32}:{signature}", '/', SECRET)
+    assert not valid_profile_token(f"{timestamp}:{signature}", '/', SECRET)
+    assert not valid_profile_token('', '/', SECRET)
+
+def test_profiling_requested_checks_the_route(monkeypatch):
+    monkeypatch.setenv(profiling.PROFILE_SECRET_ENV, SECRET)
+    monkeypatch.delenv(profiling.PROFILE_ENV, raising=False)
+    headers = {profiling.PROFILE_HEADER: make_profile_token('/')}
+    assert not profiling_requested(headers)
+    assert profiling_requested(headers, '/')
+    assert profiling_requested(flag=True)
+
+def test_only_the_newest_profiles_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILES_DIR', str(tmp_path))
+    for i in range(5):
+        for extension in ('.collapsed', '.txt'):
+            (tmp_path / f"20260101-00000{i}-000000-old{extension}").write_text('')
+    profiling.prune_profiles(keep=2)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        '20260101-000003-000000-old.collapsed', '20260101-000003-000000-old.txt',
+        '20260101-000004-000000-old.collapsed', '20260101-000004-000000-old.txt',
+    ]
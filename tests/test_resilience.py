@@ -0,0 +1,175 @@
+import threading
+import time
+
+import pytest
+
+import resilience
+from resilience import (
+    BulkheadFullError, CallerError, CircuitOpenError, InjectedFault, Upstream, UpstreamError,
+    UpstreamTimeout, inject_faults_from_env, request_budget,
+)
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+def ok(value='ok'):
+    return value
+
+def fail(status_code):
+    raise HTTPError(status_code)
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_breaker_opens_after_injected_errors():
+    upstream = Upstream('test', timeout=1.0, failure_threshold=3)
+    upstream.inject_fault(error=True)
+    for _ in range(3):
+        with pytest.raises(UpstreamError) as info:
+            upstream.call(ok)
+        assert isinstance(info.value.__cause__, InjectedFault)
+
+    upstream.clear_faults()
+    with pytest.raises(CircuitOpenError):
+        upstream.call(ok)
+    assert upstream.state()['state'] == resilience.OPEN
+    assert upstream.state()['rejected_calls'] == 1
+
+def test_half_open_trial_closes_the_breaker():
+    upstream = Upstream('test', timeout=1.0, failure_threshold=1, reset_timeout=0.05)
+    upstream.inject_fault(error=True)
+    with pytest.raises(UpstreamError):
+        upstream.call(ok)
+    with pytest.raises(CircuitOpenError):
+        upstream.call(ok)
+
+    upstream.clear_faults()
+    time.sleep(0.06)
+    assert upstream.call(ok) == 'ok'
+    assert upstream.state()['state'] == resilience.CLOSED
+
+def test_failed_half_open_trial_reopens_the_breaker():
+    upstream = Upstream('test', timeout=1.0, failure_threshold=1, reset_timeout=0.05)
+    upstream.inject_fault(error=True)
+    with pytest.raises(UpstreamError):
+        upstream.call(ok)
+    time.sleep(0.06)
+    with pytest.raises(UpstreamError):
+        upstream.call(ok)
+    with pytest.raises(CircuitOpenError):
+        upstream.call(ok)
+
+def test_timeouts_count_as_failures():
+    upstream = Upstream('test', timeout=0.05, failure_threshold=1)
+    upstream.inject_fault(delay=0.2)
+    with pytest.raises(UpstreamTimeout):
+        upstream.call(ok)
+    assert upstream.state()['state'] == resilience.OPEN
+
+def test_budget_limited_timeouts_are_not_failures():
+    upstream = Upstream('test', timeout=1.0, failure_threshold=1)
+    upstream.inject_fault(delay=0.2)
+    with request_budget(0.05):
+        with pytest.raises(UpstreamTimeout):
+            upstream.call(ok)
+    assert upstream.state()['state'] == resilience.CLOSED
+
+def test_bulkhead_rejects_calls_when_all_workers_are_busy():
+    upstream = Upstream('test', timeout=1.0, max_concurrency=2)
+    upstream.inject_fault(delay=0.3)
+    callers = [threading.Thread(target=upstream.call, args=(ok,)) for _ in range(2)]
+    for caller in callers:
+        caller.start()
+    wait_for(lambda: upstream._slots._value == 0)
+
+    started = time.monotonic()
+    with pytest.raises(BulkheadFullError):
+        upstream.call(ok)
+    assert time.monotonic() - started < 0.1
+    for caller in callers:
+        caller.join()
+    assert upstream.state()['bulkhead_rejections'] == 1
+    assert upstream.state()['state'] == resilience.CLOSED
+
+@pytest.mark.parametrize('status_code', [400, 404, 422])
+def test_caller_errors_do_not_trip_the_breaker(status_code):
+    upstream = Upstream('test', timeout=1.0, failure_threshold=1)
+    with pytest.raises(CallerError):
+        upstream.call(fail, status_code)
+    assert upstream.state()['state'] == resilience.CLOSED
+
+@pytest.mark.parametrize('status_code', [408, 429, 500, 503])
+def test_server_errors_trip_the_breaker(status_code):
+    upstream = Upstream('test', timeout=1.0, failure_threshold=1)
+    with pytest.raises(UpstreamError) as info:
+        upstream.call(fail, status_code)
+    assert not isinstance(info.value, CallerError)
+    assert upstream.state()['state'] == resilience.OPEN
+
+def test_hedge_returns_the_faster_attempt():
+    upstream = Upstream('test', timeout=1.0)
+    attempts = []
+
+    def search():
+        attempts.append(1)
+        if len(attempts) == 1:
+            time.sleep(0.5)
+            return 'slow'
+        return 'fast'
+
+    started = time.monotonic()
+    assert upstream.hedged_call(search, hedge_after=0.05) == 'fast'
+    assert time.monotonic() - started < 0.3
+    assert len(attempts) == 2
+
+def test_hedge_retries_a_failed_first_attempt():
+    upstream = Upstream('test', timeout=1.0)
+    attempts = []
+
+    def search():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("reset")
+        return 'ok'
+
+    assert upstream.hedged_call(search, hedge_after=0.05) == 'ok'
+    assert len(attempts) == 2
+
+def test_caller_errors_are_not_hedged():
+    upstream = Upstream('test', timeout=1.0, failure_threshold=1)
+    attempts = []
+
+    def search():
+        attempts.append(1)
+        fail(400)
+
+    with pytest.raises(CallerError):
+        upstream.hedged_call(search, hedge_after=0.05)
+    assert len(attempts) == 1
+    assert upstream.state()['state'] == resilience.CLOSED
+
+def test_hedge_is_skipped_when_the_bulkhead_is_full():
+    upstream = Upstream('test', timeout=0.3, max_concurrency=1)
+    attempts = []
+
+    def search():
+        attempts.append(1)
+        time.sleep(0.1)
+        return 'ok'
+
+    assert upstream.hedged_call(search, hedge_after=0.01) == 'ok'
+    assert len(attempts) == 1
+
+def test_inject_faults_from_env(monkeypatch):
+    upstreams = {'marqo': Upstream('marqo', timeout=1.0), 'openai': Upstream('openai', timeout=1.0)}
+    monkeypatch.setattr(resilience, 'UPSTREAMS', upstreams)
+    inject_faults_from_env("marqo:delay=5, openai:error, unknown:error")
+    assert (upstreams['marqo']._fault_delay, upstreams['marqo']._fault_error) == (5.0, False)
+    assert (upstreams['openai']._fault_delay, upstreams['openai']._fault_error) == (0.0, True)
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight, normalize_input
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def test_normalize_input():
+    assert normalize_input("  A Movie   about  Dogs!! ") == normalize_input("a movie about dogs")
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight('test')
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.1)
+        return 42
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', work))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [42] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {'name': 'test', 'calls': 5, 'deduplicated': 4, 'in_flight': 0}
+
+
+def test_exceptions_are_shared():
+    flight = SingleFlight('test')
+    started = threading.Event()
+
+    def work():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("upstream failed")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do('key', work)
+        except ValueError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=call)
+    follower.start()
+    leader.join()
+    follower.join()
+
+    assert errors == ["upstream failed"] * 2
+
+
+def test_interrupted_thread_leader_hands_over_to_a_follower():
+    flight = SingleFlight('test')
+    started = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        if len(calls) == 1:
+            raise Interrupted()
+        return 42
+
+    results = []
+
+    def leader():
+        with pytest.raises(Interrupted):
+            flight.do('key', work)
+
+    def follower():
+        results.append(flight.do('key', work))
+
+    threads = [threading.Thread(target=leader)]
+    threads[0].start()
+    started.wait()
+    threads += [threading.Thread(target=follower) for _ in range(3)]
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [42] * 3
+    assert len(calls) == 2
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_cancelled_follower_does_not_affect_the_others():
+    async def scenario():
+        flight = SingleFlight('test')
+
+        async def work():
+            await asyncio.sleep(0.1)
+            return 42
+
+        leader = asyncio.create_task(flight.do_async('key', work))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(flight.do_async('key', work)) for _ in range(2)]
+        await asyncio.sleep(0.02)
+        followers[0].cancel()
+        return await asyncio.gather(leader, *followers, return_exceptions=True)
+
+    leader, cancelled, follower = asyncio.run(scenario())
+    assert leader == 42
+    assert isinstance(cancelled, asyncio.CancelledError)
+    assert follower == 42
+
+
+def test_cancelled_leader_hands_over_to_a_follower():
+    async def scenario():
+        flight = SingleFlight('test')
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 42
+
+        leader = asyncio.create_task(flight.do_async('key', work))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(flight.do_async('key', work)) for _ in range(3)]
+        await asyncio.sleep(0.02)
+        leader.cancel()
+        results = await asyncio.gather(leader, *followers, return_exceptions=True)
+        return results, len(calls), flight.stats()
+
+    results, calls, stats = asyncio.run(scenario())
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1:] == [42, 42, 42]
+    assert calls == 2
+    assert stats == {'name': 'test', 'calls': 4, 'deduplicated': 3, 'in_flight': 0}
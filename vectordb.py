@@ -1,8 +1,10 @@
+from collections import OrderedDict
+from itertools import islice
 import logging
-import math
+import threading
 import marqo
 from tqdm import tqdm
-from config import NUM_SEARCH_RESULTS
+from config import BULK_SEARCH_SECONDS_PER_QUERY, BULK_SEARCH_SIZE, NUM_SEARCH_RESULTS, UPSTREAM_TIMEOUTS
 from database import get_movies_as_documents
 
 
@@ -24,7 +26,20 @@ settings = {
 
 
 mq = marqo.Client(url="http://localhost:8882")
+# Searches run on the marqo pool in resilience.py. The client waits forever by
+# default, which would keep abandoned searches holding a worker; index builds
+# keep using mq without a timeout.
+search_mq = marqo.Client(url="http://localhost:8882")
+search_mq.config.timeout = UPSTREAM_TIMEOUTS['marqo']
+# Bulk searches may take as long as the deadline of a full bulk request
+bulk_mq = marqo.Client(url="http://localhost:8882")
+bulk_mq.config.timeout = UPSTREAM_TIMEOUTS['marqo_bulk'] + BULK_SEARCH_SECONDS_PER_QUERY * BULK_SEARCH_SIZE
 index_name = "movies"
+
+# Recent search results, served when Marqo is unavailable
+SEARCH_CACHE_SIZE = 1024
+_recent_results = OrderedDict()
+_recent_results_lock = threading.Lock()
 logger = logging.getLogger(__name__)
 logger.handlers.clear()
 logger.setLevel(logging.INFO)
@@ -55,39 +70,73 @@ def init_marqo_db():
 
 
 def add_movies_to_index(movies):
-    # Verify movies data
-    logger.info(f"Adding {len(movies)} documents to index")
+    """Add documents to the index in batches. movies may be any iterable,
+    e.g. the stream from get_movies_as_documents; only one batch is held at a time."""
+    logger.info("Adding documents to index")
     batch_size = 100
-    
+    movies = iter(movies)
+    total_docs = 0
+
     # Add documents with progress
-    total_docs = len(movies)
-    num_batches = math.ceil(total_docs / batch_size)
-    
-    for i in tqdm(range(0, total_docs, batch_size), total=num_batches, desc="Indexing documents"):
-        batch = movies[i:i + batch_size]
-        try:
-            result = mq.index(index_name).add_documents(
-                documents=batch,
-                client_batch_size=batch_size)
-        except Exception as e:
-            print(f"Error processing batch {i//batch_size + 1}: {str(e)}")
-            continue
+    with tqdm(desc="Indexing documents", unit="docs") as progress:
+        for batch_number, batch in enumerate(iter(lambda: list(islice(movies, batch_size)), []), 1):
+            try:
+                result = mq.index(index_name).add_documents(
+                    documents=batch,
+                    client_batch_size=batch_size)
+            except Exception as e:
+                print(f"Error processing batch {batch_number}: {str(e)}")
+                continue
+            finally:
+                total_docs += len(batch)
+                progress.update(len(batch))
 
-    logger.info('Documents added successfully')
+    logger.info(f'{total_docs} documents added successfully')
     
 def search_movies(user_keywords,filter):
     logger.info(f"Searching for q: {user_keywords}, filter: {filter}")
     if (filter):
-        results = mq.index(index_name).search(
+        results = search_mq.index(index_name).search(
         q=user_keywords,
         filter_string=filter,
         limit = NUM_SEARCH_RESULTS
         )
     else:
-        results = mq.index(index_name).search(user_keywords)
+        results = search_mq.index(index_name).search(user_keywords)
     
     # Debug results structure
     #logger.info(f"Found {len(results['hits'])} results")
+    with _recent_results_lock:
+        _recent_results[(user_keywords, filter)] = results
+        _recent_results.move_to_end((user_keywords, filter))
+        if len(_recent_results) > SEARCH_CACHE_SIZE:
+            _recent_results.popitem(last=False)
     return results
+
+def bulk_search_movies(searches):
+    """Run several (user_keywords, filter) searches in one Marqo bulk request.
+
+    Returns the results in the same order as searches. Raises if the Marqo
+    server does not support bulk search; callers fall back to search_movies.
+    """
+    logger.info(f"Bulk searching {len(searches)} queries")
+    queries = [
+        {"index": index_name, "q": user_keywords, "filter": filter, "limit": NUM_SEARCH_RESULTS}
+        if filter else {"index": index_name, "q": user_keywords}
+        for user_keywords, filter in searches
+    ]
+    all_results = bulk_mq.bulk_search(queries)['result']
+    with _recent_results_lock:
+        for search, results in zip(searches, all_results):
+            _recent_results[search] = results
+            _recent_results.move_to_end(search)
+        while len(_recent_results) > SEARCH_CACHE_SIZE:
+            _recent_results.popitem(last=False)
+    return all_results
+
+def cached_search(user_keywords, filter):
+    """Return the last Marqo results for this query and filter, or None."""
+    with _recent_results_lock:
+        return _recent_results.get((user_keywords, filter))
     
         
\ No newline at end of file